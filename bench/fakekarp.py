@@ -0,0 +1,165 @@
+""" A stand-in for Karp, serving generated term-swefin entries.
+
+    python3 -m bench.fakekarp [--entries 10000] [--latency 0.02] [--port 4001]
+
+    Understands the queries built by utils.wordlists: startswith and regexp
+    on the source or target form, restricted to subtypes, sorted by the
+    source or target form, with start/size paging.
+"""
+import argparse
+import bisect
+import json
+import random
+import re
+import string
+import time
+
+import tornado.gen
+import tornado.ioloop
+import tornado.web
+
+SUBTYPES = ['muminfigurer', 'socialord', 'avfall', 'grönsaker', 'fordon', 'yrken', 'sport', 'mat']
+LETTERS = string.ascii_lowercase + 'åäö'
+
+
+def make_entries(number, seed=1):
+    """ Generate entries shaped like the ones in term-swefin """
+    rand = random.Random(seed)
+
+    def word():
+        return ''.join(rand.choice(LETTERS) for _ in range(rand.randint(3, 12)))
+
+    entries = []
+    for ix in range(number):
+        base = word()
+        targets = [{'wordform': word()} for _ in range(rand.randint(1, 3))]
+        if rand.random() < 0.2:
+            targets[0]['comment'] = '(ark.)'
+        compounds = [base + word() for _ in range(rand.randint(0, 3))]
+        entries.append({
+            '_id': 'entry{}'.format(ix),
+            '_source': {
+                'baselang': {'form': [{'wordform': base}], 'compound': compounds},
+                'targetlang': [{'form': targets,
+                                'compound': [word() + ' (ark.)' for _ in compounds]}],
+                'subtype': rand.sample(SUBTYPES, rand.randint(1, 2)),
+            }})
+    return entries
+
+
+def source_form(entry):
+    return entry['_source']['baselang']['form'][0]['wordform']
+
+
+def target_form(entry):
+    return entry['_source']['targetlang'][0]['form'][0]['wordform']
+
+
+class Lexicon(object):
+    """ The entries, sorted both ways """
+
+    def __init__(self, entries):
+        # Entries with the same form are ordered by id, like with a sort_tiebreaker
+        self.by_source = sorted(entries, key=lambda entry: (source_form(entry), entry['_id']))
+        self.by_target = sorted(entries, key=lambda entry: (target_form(entry), entry['_id']))
+        self.source_forms = [source_form(entry) for entry in self.by_source]
+        self.target_forms = [target_form(entry) for entry in self.by_target]
+        # Matching is slow in python, remember the answers so that the
+        # benchmark measures the backend rather than this server
+        self.answers = {}
+
+    def query(self, q, sort=None):
+        """ All entries matching a query string from utils.wordlists.build_query """
+        if (q, sort) not in self.answers:
+            self.answers[(q, sort)] = self.match(q, sort)
+        return self.answers[(q, sort)]
+
+    def match(self, q, sort):
+        parts = q.split('||')
+        word_q = parts[1].split('|')
+        field, op, value = word_q[1], word_q[2], '|'.join(word_q[3:])
+        subtypes = set()
+        for part in parts[2:]:
+            fields = part.split('|')
+            if fields[1] == 'subtype.search':
+                subtypes = set(fields[3:])
+        target = field.startswith('targetform')
+        by_target = bool(sort) and sort.startswith('targetform')
+        entries = self.by_target if by_target else self.by_source
+        getform = target_form if target else source_form
+        if op == 'startswith' and target == by_target:
+            # The entries are sorted by the searched form, the hits are next to each other
+            forms = self.target_forms if target else self.source_forms
+            entries = entries[bisect.bisect_left(forms, value):bisect.bisect_left(forms, value + '\uffff')]
+            match = lambda form: True
+        elif op == 'startswith':
+            match = lambda form: form.startswith(value)
+        elif value == '.*':
+            match = lambda form: True
+        else:
+            pattern = re.compile(value)
+            match = lambda form: pattern.fullmatch(form) is not None
+        return [entry for entry in entries
+                if (not subtypes or subtypes.intersection(entry['_source']['subtype']))
+                and match(getform(entry))]
+
+
+class BaseHandler(tornado.web.RequestHandler):
+    async def prepare(self):
+        await tornado.gen.sleep(self.settings['latency'])
+
+
+class QueryHandler(BaseHandler):
+    def get(self):
+        hits = self.settings['lexicon'].query(self.get_query_argument('q'),
+                                              self.get_query_argument('sort', None))
+        start = int(self.get_query_argument('start', 0))
+        size = int(self.get_query_argument('size', 25))
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps({'hits': {'total': len(hits), 'hits': hits[start:start + size]}}))
+
+
+class StatlistHandler(BaseHandler):
+    def get(self):
+        counts = {}
+        for entry in self.settings['lexicon'].by_source:
+            for subtype in entry['_source']['subtype']:
+                counts[subtype] = counts.get(subtype, 0) + 1
+        self.write({'stat_table': [[subtype, count] for subtype, count in sorted(counts.items())]})
+
+
+class CheckuserHandler(BaseHandler):
+    def get(self):
+        self.write({'authenticated': True,
+                    'permitted_resources': {'lexica': {'term-swefin': {'read': True, 'write': True}}}})
+
+
+def make_app(entries, latency):
+    return tornado.web.Application([(r'/query', QueryHandler),
+                                    (r'/statlist', StatlistHandler),
+                                    (r'/checkuser', CheckuserHandler)],
+                                   lexicon=Lexicon(make_entries(entries)),
+                                   latency=latency)
+
+
+def serve(port, entries, latency):
+    """ Run the fake Karp until killed """
+    start = time.time()
+    app = make_app(entries, latency)
+    app.listen(port, address='127.0.0.1')
+    print('Fake Karp: {} entries on port {} ({:.1f} s to generate)'.format(
+        entries, port, time.time() - start), flush=True)
+    tornado.ioloop.IOLoop.current().start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=10000)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds added to every answer')
+    parser.add_argument('--port', type=int, default=4001)
+    args = parser.parse_args()
+    serve(args.port, args.entries, args.latency)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+""" Compare substring search with the trigram index to a regexp scan,
+    the way Karp answers `contains` searches.
+
+    python3 -m bench.ngram [--forms 50000] [--queries 200] [--hits hits.json]
+
+    `--hits` may point to a json file with a Karp query answer, otherwise
+    random word forms are generated.
+"""
+import argparse
+import json
+import random
+import re
+import string
+import time
+
+import utils.mirror as mirror
+import utils.ngram as ngram
+
+LETTERS = string.ascii_lowercase + 'åäö'
+
+
+def random_forms(number):
+    " Generate word like strings "
+    rand = random.Random(1)
+    return sorted(''.join(rand.choice(LETTERS) for _ in range(rand.randint(3, 14)))
+                  for _ in range(number))
+
+
+def karp_forms(path):
+    " Read the source language forms from a Karp answer "
+    hits = json.load(open(path, encoding='utf-8'))['hits']['hits']
+    return sorted(form for hit in hits for form in mirror.source_forms(hit['_source']))
+
+
+def timed(func, queries):
+    " Run func on all queries, return seconds per query and the number of hits "
+    hits = 0
+    start = time.perf_counter()
+    for query in queries:
+        hits += len(func(query))
+    return (time.perf_counter() - start) / len(queries), hits
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--forms', type=int, default=50000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--hits')
+    args = parser.parse_args()
+
+    forms = karp_forms(args.hits) if args.hits else random_forms(args.forms)
+    rand = random.Random(2)
+    queries = []
+    for _ in range(args.queries):
+        form = rand.choice(forms)
+        start = rand.randint(0, max(0, len(form) - 3))
+        queries.append(form[start:start + rand.randint(2, 5)])
+
+    start = time.perf_counter()
+    index = ngram.build(forms, float('inf'))
+    build_time = time.perf_counter() - start
+
+    def regexp(word):
+        pattern = re.compile('.*{}.*'.format(re.escape(word)))
+        return [ix for ix, form in enumerate(forms) if pattern.match(form)]
+
+    index_time, index_hits = timed(index.search, queries)
+    regexp_time, regexp_hits = timed(regexp, queries)
+    assert index_hits == regexp_hits
+
+    print('forms:           {}'.format(len(forms)))
+    print('index size:      {:.1f} MB, built in {:.2f} s'.format(index.size / 1024 / 1024, build_time))
+    print('trigram search:  {:.3f} ms/query'.format(index_time * 1000))
+    print('regexp scan:     {:.3f} ms/query'.format(regexp_time * 1000))
+    print('speedup:         {:.0f}x'.format(regexp_time / index_time))
+
+
+if __name__ == '__main__':
+    main()
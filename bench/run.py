@@ -0,0 +1,206 @@
+""" Benchmark the backend against a local fake Karp.
+
+    python3 -m bench.run [--sizes 1000,10000,50000] [--requests 200]
+                         [--concurrency 20] [--latency 0.02] [--output bench_results.json]
+
+    For every lexicon size, a fake Karp (bench/fakekarp.py) is started in
+    its own process, and route.Application is loaded with concurrent
+    requests for each scenario: json search, empty query browse, contains
+    search and html export. Latency percentiles and requests per second are
+    printed and saved as json, to be compared between versions.
+
+    Uses the settings of term-swefin from conf/settings.json, with Karp and
+    the subtype file replaced.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import subprocess
+import tempfile
+import time
+
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httputil import url_concat
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
+
+import bench.fakekarp as fakekarp
+import conf.settings as settings
+import route
+import utils.diskcache as diskcache
+import utils.wordlists as wordlists
+
+MODE = 'bench'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(port, timeout=120):
+    """ Wait until something listens to the port """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('Fake Karp did not start')
+
+
+def scenarios(requests, rand):
+    """ The urls to request, per scenario """
+    def subtypes():
+        return ','.join(rand.sample(fakekarp.SUBTYPES, rand.randint(1, 3)))
+
+    def letters(number):
+        return ''.join(rand.choice(fakekarp.LETTERS) for _ in range(number))
+
+    def url(**args):
+        return url_concat('/search', dict(args, mode=MODE))
+
+    return {
+        'search': [url(q=letters(2), subtypes=subtypes(), lang=rand.choice(['sv', 'fi']))
+                   for _ in range(requests)],
+        'browse': [url(subtypes=subtypes(), lang=rand.choice(['sv', 'fi']))
+                   for _ in range(requests)],
+        'contains': [url(q=letters(3), contains='true', subtypes=subtypes())
+                     for _ in range(requests)],
+        'export': [url(format='html', subtypes=subtypes())
+                   for _ in range(max(5, requests // 10))],
+    }
+
+
+async def load(base, urls, concurrency):
+    """ Request all urls, `concurrency` at a time. Return the latencies and number of errors. """
+    client = AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    queue = list(reversed(urls))
+    latencies = []
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        while queue:
+            url = queue.pop()
+            start = time.perf_counter()
+            response = await client.fetch(base + url, raise_error=False, request_timeout=600)
+            latencies.append(time.perf_counter() - start)
+            if response.code != 200:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    wall = time.perf_counter() - start
+    client.close()
+    return latencies, errors, wall
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def summarize(entries, scenario, latencies, errors, wall):
+    return {'entries': entries,
+            'scenario': scenario,
+            'requests': len(latencies),
+            'errors': errors,
+            'rps': round(len(latencies) / wall, 1),
+            'mean_ms': round(1000 * sum(latencies) / len(latencies), 2),
+            'p50_ms': round(1000 * percentile(latencies, 0.50), 2),
+            'p95_ms': round(1000 * percentile(latencies, 0.95), 2),
+            'p99_ms': round(1000 * percentile(latencies, 0.99), 2)}
+
+
+def configure(karp_port, typefile, cache):
+    """ Point the term-swefin settings to the fake Karp """
+    settings.karp = 'http://127.0.0.1:{}'.format(karp_port)
+    values = dict(settings.config('term-swefin').values, subtypes=typefile)
+    settings.configs[MODE] = settings.ModeConfig(MODE, values)
+    settings.modes = settings.modes | {MODE}
+    with open(typefile, 'w', encoding='utf-8') as subtypes:
+        subtypes.write('\n'.join(fakekarp.SUBTYPES))
+    wordlists.search_cache.clear()
+    wordlists.export_cache.clear()
+    wordlists.fragment_cache.clear()
+    wordlists.hit_counts.counts.clear()
+    # Every size writes the same subtypes, results on disk would be reused
+    wordlists.disk_cache = diskcache.DiskCache('disk', os.path.join(os.path.dirname(typefile), 'karp.sqlite3'), 0)
+    wordlists.search_cache.maxsize = int(settings.config().cache_size) if cache else 0
+
+
+def version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run(args):
+    results = []
+    rand = random.Random(3)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for entries in args.sizes:
+            karp_port = free_port()
+            karp = multiprocessing.Process(target=fakekarp.serve, args=(karp_port, entries, args.latency))
+            karp.start()
+            try:
+                wait_for(karp_port)
+                configure(karp_port, os.path.join(tmpdir, 'subtypes.txt'), args.cache)
+                sockets = tornado.netutil.bind_sockets(0, '127.0.0.1')
+                base = 'http://127.0.0.1:{}'.format(sockets[0].getsockname()[1])
+                server = tornado.httpserver.HTTPServer(route.Application({}))
+                server.add_sockets(sockets)
+                for scenario, urls in scenarios(args.requests, rand).items():
+                    latencies, errors, wall = tornado.ioloop.IOLoop.current().run_sync(
+                        lambda: load(base, urls, args.concurrency))
+                    result = summarize(entries, scenario, latencies, errors, wall)
+                    print('{entries:>6} {scenario:<9} {rps:>8} req/s  p50 {p50_ms:>8} ms  '
+                          'p95 {p95_ms:>8} ms  p99 {p99_ms:>8} ms  errors {errors}'.format(**result))
+                    results.append(result)
+                server.stop()
+            finally:
+                karp.terminate()
+                karp.join()
+    wordlists.convert_pool.shutdown()
+    wordlists.pdf_pool.shutdown()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1000,10000,50000',
+                        type=lambda sizes: [int(size) for size in sizes.split(',')])
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds added by the fake Karp')
+    parser.add_argument('--no-cache', dest='cache', action='store_false', help='disable the search cache')
+    parser.add_argument('--output', default='bench_results.json')
+    args = parser.parse_args()
+
+    results = run(args)
+    report = {'version': version(),
+              'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(),
+              'settings': {'requests': args.requests, 'concurrency': args.concurrency,
+                           'latency': args.latency, 'cache': args.cache},
+              'results': results}
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    print('Saved to', args.output)
+
+
+if __name__ == '__main__':
+    # As in route.py
+    multiprocessing.set_start_method('spawn')
+    main()
@@ -1,44 +1,119 @@
-""" Settings! """
+""" Settings!
+    The configuration of every mode is resolved once, when the settings are
+    (re)loaded, into a read only ModeConfig.
+"""
 import json
+import logging
 import os
+import types
 
 import utils.errors as errors
 
 path = os.path.dirname(os.path.abspath(__file__))
-conf = json.load(open(os.path.join(path, 'settings.json'), encoding='utf-8'))
-default_conf = json.load(open(os.path.join(path, 'settings_default.json'), encoding='utf-8'))
 
 
 karp = 'https://ws.spraakbanken.gu.se/ws/karp/v5'
 ok_status = 'granskat och klart'
 
+
+class ModeConfig(object):
+    """ The complete configuration of one mode (called `name`).
+        Fields are read as attributes, with dots replaced by underscores
+        (`config.baseform_search` for "baseform.search"), or with `get`.
+    """
+
+    def __init__(self, mode, values):
+        object.__setattr__(self, 'name', mode)
+        object.__setattr__(self, 'values', types.MappingProxyType(values))
+        for key, value in values.items():
+            object.__setattr__(self, key.replace('.', '_'), value)
+
+    def __setattr__(self, key, value):
+        raise AttributeError('The configuration is read only')
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def get(self, key, default=None):
+        if key in self.values:
+            return self.values[key]
+        if default is not None:
+            return default
+        raise errors.ConfigurationError(key, self.name)
+
+
+def freeze(value):
+    " Make lists and dicts read only "
+    if isinstance(value, list):
+        return tuple(freeze(val) for val in value)
+    if isinstance(value, dict):
+        return types.MappingProxyType({key: freeze(val) for key, val in value.items()})
+    return value
+
+
+def compile_configs(conf, default_conf):
+    """ Resolve the configuration of every mode. The mode's own settings in
+        settings.json win over the defaults in settings.json, which win over
+        the mode's settings and the defaults in settings_default.json.
+    """
+    modes = (set(conf.keys()) | set(default_conf.keys())) - {'default'}
+    configs = {}
+    for mode in modes | {'default'}:
+        values = {}
+        for layer in [default_conf.get('default', {}), default_conf.get(mode, {}),
+                      conf.get('default', {}), conf.get(mode, {})]:
+            values.update(layer)
+        configs[mode] = ModeConfig(mode, {key: freeze(val) for key, val in values.items()})
+    return frozenset(modes), configs
+
+
+def stamps():
+    """ Identify the versions of the settings files """
+    result = []
+    for name in ['settings.json', 'settings_default.json']:
+        try:
+            stat = os.stat(os.path.join(path, name))
+            result.append((stat.st_ino, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            result.append(None)
+    return result
+
+
+def changed():
+    """ Whether the settings files have been changed since they were loaded """
+    return stamps() != loaded
+
+
+def load():
+    """ Read the settings files and replace the current configuration """
+    global modes, configs, loaded
+    # Taken first, so that changes made while reading are seen next time
+    loaded = stamps()
+    conf = json.load(open(os.path.join(path, 'settings.json'), encoding='utf-8'))
+    default_conf = json.load(open(os.path.join(path, 'settings_default.json'), encoding='utf-8'))
+    # Everything is resolved before anything is replaced, so a broken file keeps the old settings
+    modes, configs = compile_configs(conf, default_conf)
+    logging.info('Loaded settings for %s', ', '.join(sorted(modes)))
+
+
 def get_modes():
-    modes = set(conf.keys())
-    for mode in default_conf.keys():
-        modes.add(mode)
-    modes.discard('default')
     return modes
 
 
-def lookup(key):
-    return conf.get(key, default_conf[key])
+def config(mode='default'):
+    """ The configuration of a mode (the defaults for unknown modes) """
+    return configs.get(mode) or configs['default']
 
 
 def get(key, mode="default", default=None):
-    if key in conf.get(mode, {}):
-        return conf[mode][key]
-    if key in conf.get('default'):
-        return conf['default'][key]
-    if key in default_conf.get(mode, {}):
-        return default_conf[mode][key]
-    if key in default_conf.get('default', {}):
-        return default_conf['default'][key]
-    if default is not None:
-        return default
-    raise errors.ConfigurationError(key, mode)
+    return config(mode).get(key, default)
 
 
 def get_first_letter(lang, mode):
-    if lang in get('first_letter', mode, {}):
-        return get('first_letter', mode)[lang]
+    first_letters = config(mode).get('first_letter', {})
+    if lang in first_letters:
+        return first_letters[lang]
     return get('standard_first_letter', default='a')
+
+
+load()
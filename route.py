@@ -1,14 +1,22 @@
 """ Main module, this is where the applications routes are specified """
 import logging
+import multiprocessing
+import signal
 import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
+import tornado.process
 import tornado.web
 from tornado.options import define, options
 
+import utils.compression as compression
+import utils.karp as karp
+import utils.subtypes as subtypes
 import utils.wordlists as wordlists
 
 define("port", default=4000, help="run on the given port", type=int)
 define("develop", default=False, help="Run in develop environment", type=bool)
+define("processes", default=1, help="number of worker processes (0 = one per cpu)", type=int)
 
 
 # Setup the Tornado Application
@@ -22,18 +30,30 @@ class Application(tornado.web.Application):
         self.declared_handlers = [
             (r"/",         wordlists.Info),
             (r"/search",   wordlists.SearchHandler),
+            (r"/search/batch", wordlists.BatchSearchHandler),
             (r"/subtypes", wordlists.SubtypeHandler),
             (r"/modes", wordlists.ModeHandler),
             (r"/publish/(.*)", wordlists.PublishHandler),
             (r"/unpublish/(.*)", wordlists.UnpublishHandler),
             (r"/css", wordlists.CSSHandler),
+            (r"/reload", wordlists.ReloadHandler),
+            (r"/metrics", wordlists.MetricsHandler),
         ]
 
+        # All calls to Karp are made asynchronously by a shared client
+        karp.configure()
+        # Read the published subtypes once, they are then kept in memory
+        subtypes.registry.load_all()
+
         # Setup the Tornado Application
         tornado.web.Application.__init__(self, self.declared_handlers, **settings)
+        # Search results are compressed (gzip or brotli) if the client accepts it
+        self.add_transform(compression.CompressionTransform)
 
 
 if __name__ == '__main__':
+    # Worker pools spawn rather than fork their processes, the server may have threads running
+    multiprocessing.set_start_method('spawn')
     tornado.log.enable_pretty_logging()
     tornado.options.parse_command_line()
 
@@ -42,16 +62,42 @@ if __name__ == '__main__':
         tornado_settings['develop'] = True
         logging.getLogger().setLevel(logging.DEBUG)
 
+    # Open the socket before forking, so that all workers share it
+    sockets = tornado.netutil.bind_sockets(options.port)
+    if options.processes != 1:
+        if options.develop:
+            raise SystemExit('--develop cannot be used with several processes')
+        # The parent only restarts workers that die, SIGHUP must not stop it
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        tornado.process.fork_processes(options.processes)
+        # Let every worker see publications made by the others at once
+        subtypes.registry.check_interval = 0
+
     # Instantiate Application
     application = Application(tornado_settings)
-    application.listen(options.port)
-    print('Running on port', options.port)
 
     # Start HTTP Server
     http_server = tornado.httpserver.HTTPServer(application)
+    http_server.add_sockets(sockets)
+    print('Running on port', options.port)
+
+    # Drop old results from the Karp results kept on disk
+    wordlists.start_disk_cache()
+    # Download the local copies of the wordlists, if any
+    wordlists.start_mirrors()
+    # Keep the number of hits of popular subtypes up to date
+    wordlists.start_hit_counts()
+    # Keep track of all subtypes in Karp and their sizes
+    wordlists.start_catalogues()
+    # Render the html exports of the published subtypes
+    wordlists.start_exports()
 
     # Get a handle to the instance of IOLoop
-    ioloop = tornado.ioloop.IOLoop.instance()
+    ioloop = tornado.ioloop.IOLoop.current()
+
+    # Reread the settings when the files change, or on SIGHUP
+    wordlists.start_settings_check()
+    signal.signal(signal.SIGHUP, lambda signum, frame: ioloop.add_callback_from_signal(wordlists.reload_settings))
 
     # Start the IOLoop
     ioloop.start()
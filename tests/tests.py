@@ -1,13 +1,46 @@
 " Basics tests for the backend "
+import asyncio
+import gzip
 import json
+import multiprocessing
+import re
+import os
+import tempfile
+import unittest
+from unittest import mock
 from tornado.httputil import url_concat
-from tornado.testing import AsyncHTTPTestCase
+from tornado.testing import AsyncHTTPTestCase, AsyncTestCase, gen_test
 
+import conf.settings as settings
 import route
+import bench.fakekarp as fakekarp
+import utils.cache as cache
+import utils.catalogue as catalogue
+import utils.errors as errors
+import utils.compression as compression
+import utils.convert as convert
+import utils.cursor as cursor
+import utils.diskcache as diskcache
+import utils.exports as exports
+import utils.handlers as handlers
+import utils.karp as karp
+import utils.metrics as metrics
+import utils.mirror as mirror
+import utils.projection as projection
+import utils.stylesheets as stylesheets
+import utils.subtypes as subtypes
+import utils.workers as workers
+import utils.wordlists as wordlists
 
 # TODO must begin with getting test mode in settings.json
 
 
+def configured(**values):
+    """ Patch the settings of every mode, `values` over the defaults """
+    config = settings.ModeConfig('test', dict(settings.config().values, **values))
+    return mock.patch('conf.settings.configs', {'default': config})
+
+
 class TestBackend(AsyncHTTPTestCase):
     def get_app(self):
         settings = {}
@@ -117,3 +150,636 @@ class TestBackend(AsyncHTTPTestCase):
         url = url_concat('/search', key_arg)
         response = self.fetch(url)
         self.assertEqual(response.code, 200)
+
+
+class TestStylesheets(AsyncHTTPTestCase):
+    def get_app(self):
+        return route.Application({})
+
+    def setUp(self):
+        super().setUp()
+        self.upstream = {'body': b'div {}', 'etag': '"v1"'}
+        self.requests = []
+        for patcher in [mock.patch('utils.karp.fetch', self.fetch_css),
+                        mock.patch.dict(stylesheets.stylesheets, clear=True)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def fetch_css(self, url, mode, headers=None, raise_error=True):
+        self.requests.append(headers)
+        if headers.get('If-None-Match') == self.upstream['etag']:
+            return mock.Mock(code=304, headers={})
+        return mock.Mock(code=200, body=self.upstream['body'], headers={'Etag': self.upstream['etag']})
+
+    def test_conditional(self):
+        """ Clients get 304 for the version they have """
+        first = self.fetch('/css?mode=term-swefin')
+        self.assertEqual(first.code, 200)
+        self.assertEqual(first.body, b'div {}')
+        etag = first.headers['Etag']
+        again = self.fetch('/css?mode=term-swefin', headers={'If-None-Match': etag})
+        self.assertEqual(again.code, 304)
+        since = self.fetch('/css?mode=term-swefin', headers={'If-Modified-Since': first.headers['Last-Modified']})
+        self.assertEqual(since.code, 304)
+        self.assertEqual(len(self.requests), 1)
+
+    def test_reload(self):
+        """ Old copies are revalidated upstream, and replaced when changed """
+        self.fetch('/css?mode=term-swefin')
+        self.io_loop.run_sync(lambda: stylesheets.refresh('term-swefin'))
+        self.assertEqual(self.requests[-1]['If-None-Match'], '"v1"')
+        old_etag = stylesheets.stylesheets['term-swefin'].etag
+        self.upstream = {'body': b'p {}', 'etag': '"v2"'}
+        self.io_loop.run_sync(lambda: stylesheets.refresh('term-swefin'))
+        response = self.fetch('/css?mode=term-swefin', headers={'If-None-Match': old_etag})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, b'p {}')
+
+
+class TestCache(unittest.TestCase):
+    def test_lru(self):
+        """ The least recently used entry is evicted first """
+        lru = cache.LRUCache('test', 2)
+        lru.set(('a', 1), 'one', 10)
+        lru.set(('a', 2), 'two', 10)
+        lru.get(('a', 1))
+        lru.set(('b', 3), 'three', 10)
+        self.assertEqual(lru.get(('a', 1)), 'one')
+        self.assertIsNone(lru.get(('a', 2)))
+        self.assertEqual(lru.stats()['evictions'], 1)
+
+    def test_invalidate(self):
+        """ Invalidating a mode only drops that mode's entries """
+        lru = cache.LRUCache('test', 10)
+        lru.set(('a', 1), 'one', 10)
+        lru.set(('b', 1), 'one', 10)
+        lru.invalidate('a')
+        self.assertIsNone(lru.get(('a', 1)))
+        self.assertEqual(lru.get(('b', 1)), 'one')
+
+    def test_bytes(self):
+        """ With maxbytes, entries are evicted to keep the total size down """
+        lru = cache.LRUCache('test', 10, maxbytes=100)
+        lru.set(('a', 1), 'one', 10, size=40)
+        lru.set(('a', 2), 'two', 10, size=40)
+        lru.set(('a', 3), 'big', 10, size=101)
+        self.assertIsNone(lru.get(('a', 3)))
+        lru.grow(('a', 1), 30)
+        self.assertIsNone(lru.get(('a', 2)))
+        self.assertEqual(lru.get(('a', 1)), 'one')
+        self.assertEqual(lru.stats()['bytes'], 70)
+        lru.invalidate('a')
+        self.assertEqual(lru.stats()['bytes'], 0)
+
+    def test_fragments(self):
+        """ Fragments are only returned for the same digest, and bounded in bytes """
+        fragments = cache.FragmentCache('test', 3 * (cache.FragmentCache.OVERHEAD + 100))
+        fragments.set('a', 1, b'<div>a</div>')
+        self.assertEqual(fragments.get('a', 1), b'<div>a</div>')
+        self.assertIsNone(fragments.get('a', 2))
+        for key in 'bcd':
+            fragments.set(key, 1, b'<div>' + key.encode() + b'</div>')
+        self.assertIsNone(fragments.get('a', 1))
+        self.assertEqual(fragments.stats()['evictions'], 1)
+        self.assertLessEqual(fragments.stats()['bytes'], fragments.maxbytes)
+
+    def test_disk(self):
+        """ Results are kept between connections, for their version only, and compacted """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'cache', 'karp.sqlite3')
+            disk = diskcache.DiskCache('test', path, 1024 * 1024)
+            disk.set(('a', 'q1'), 'v1', {'hits': {'total': 1}}, 10)
+            disk.set(('a', 'q2'), 'v1', {'hits': {'total': 2}}, -1)
+            disk.set(('b', 'q1'), 'v1', {'hits': {'total': 3}}, 10)
+            restarted = diskcache.DiskCache('test', path, 1024 * 1024)
+            self.assertEqual(restarted.get(('a', 'q1'), 'v1'), {'hits': {'total': 1}})
+            self.assertIsNone(restarted.get(('a', 'q1'), 'v2'))
+            self.assertIsNone(restarted.get(('a', 'q2'), 'v1'))
+            self.assertEqual(restarted.compact({'a': 'v1', 'b': 'v2'}), 1)
+            self.assertEqual(restarted.stats()['size'], 1)
+            restarted.maxbytes = 1
+            restarted.compact({'a': 'v1'})
+            self.assertIsNone(restarted.get(('a', 'q1'), 'v1'))
+            self.assertEqual(restarted.stats()['evictions'], 1)
+
+    def test_disk_size(self):
+        """ The file is kept to maxbytes, the results read last are kept """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'karp.sqlite3')
+            disk = diskcache.DiskCache('test', path, 64 * 1024)
+            for n in range(200):
+                disk.set(('a', n), 'v1', {'text': os.urandom(500).hex()}, 10)
+            # The file stops growing at twice maxbytes
+            self.assertGreater(disk.stats()['skipped'], 0)
+            self.assertLessEqual(disk.stats()['bytes'], 2 * 64 * 1024)
+            self.assertIsNotNone(disk.get(('a', 0), 'v1'))
+            self.assertGreater(disk.compact({'a': 'v1'}, disk.take_used()), 0)
+            self.assertLessEqual(os.path.getsize(path), 64 * 1024)
+            self.assertIsNotNone(disk.get(('a', 0), 'v1'))
+            self.assertIsNone(disk.get(('a', 1), 'v1'))
+
+
+class TestSearchCache(AsyncTestCase):
+    @gen_test
+    async def test_bytes(self):
+        """ Search results are kept in memory up to cache_mb, measured on Karp's answer """
+        calls = []
+
+        async def call(path, params, mode, auth=None, timeout=None, with_size=False):
+            calls.append(params['q'])
+            return {'hits': {'total': 0, 'hits': []}}, len(params['q'])
+
+        with mock.patch('utils.karp.call', call), \
+             mock.patch('utils.wordlists.search_cache', cache.LRUCache('search', 10, maxbytes=100)), \
+             mock.patch('utils.wordlists.disk_cache', diskcache.DiskCache('disk', 'unused', 0)), \
+             mock.patch.object(subtypes.registry, 'digest', lambda mode: 'v1'):
+            for q in ['small', 'big' * 50, 'small', 'big' * 50]:
+                params = {'resource': 'test', 'mode': 'test', 'q': q, 'size': 10}
+                await wordlists.make_call(params, 'term-swefin')
+            self.assertEqual(calls, ['small', 'big' * 50, 'big' * 50])
+            self.assertEqual(wordlists.search_cache.stats()['bytes'], 5)
+
+
+class TestAuthCache(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.calls = []
+        self.answer = {'authenticated': True, 'permitted_resources': {'lexica': {'test-res': {}}}}
+        conf = {'resource': 'test-res', 'auth_cache_ttl': 60, 'auth_cache_fail_ttl': 60}
+        for patcher in [mock.patch('utils.karp.call', self.call),
+                        configured(**conf),
+                        mock.patch('utils.handlers.auth_cache', cache.LRUCache('auth', 10))]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def call(self, path, params, mode, auth=None):
+        self.calls.append(auth)
+        if self.answer is None:
+            raise errors.KarpError('Bad answer from Karp')
+        return self.answer
+
+    def handler(self, auth):
+        handler = mock.Mock()
+        handler.request.headers = {'Authorization': auth}
+        return handler
+
+    async def authenticate(self, auth):
+        await handlers.SafeHandler.authenticate(self.handler(auth), 'test')
+
+    @gen_test
+    async def test_cached(self):
+        """ Logins are remembered under a hash of the credentials """
+        await self.authenticate('Basic dXNlcjpwYXNz')
+        await self.authenticate('Basic dXNlcjpwYXNz')
+        self.assertEqual(len(self.calls), 1)
+        keys = list(handlers.auth_cache.entries)
+        self.assertNotIn('dXNlcjpwYXNz', repr(keys))
+
+    @gen_test
+    async def test_failures(self):
+        """ Failed logins are remembered, Karp errors are not """
+        self.answer = {'authenticated': False}
+        for _ in range(2):
+            with self.assertRaises(errors.AuthenticationError):
+                await self.authenticate('Basic YmFkOmJhZA==')
+        self.assertEqual(len(self.calls), 1)
+        self.answer = None
+        for _ in range(2):
+            with self.assertRaises(errors.AuthenticationError):
+                await self.authenticate('Basic b3RoZXI6b3RoZXI=')
+        self.assertEqual(len(self.calls), 3)
+
+    @gen_test
+    async def test_not_permitted(self):
+        """ Users that may not edit the resource are stopped """
+        self.answer = {'authenticated': True, 'permitted_resources': {'lexica': {'other-res': {}}}}
+        handler = self.handler('Basic dXNlcjpwYXNz')
+        with self.assertRaises(errors.AuthenticationError):
+            await handlers.SafeHandler.authenticate(handler, 'test')
+        self.assertEqual(handler.return_error.call_count, 1)
+
+
+class TestSubtypeRegistry(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.typefile = os.path.join(self.tmpdir.name, 'types', 'subtypes.txt')
+        conf = {'subtypes': self.typefile, 'subtypes_check_interval': 0}
+        patcher = configured(**conf)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def test_update(self):
+        """ Updates are written to file and seen by the registry """
+        registry = subtypes.SubtypeRegistry()
+        self.assertEqual(registry.get('test'), [])
+        os.chmod(self.typefile, 0o664)
+        registry.update(['a', 'b'], 'test')
+        self.assertEqual(registry.get('test'), ['a', 'b'])
+        self.assertEqual(open(self.typefile).read(), 'a\nb')
+        self.assertEqual(os.stat(self.typefile).st_mode & 0o777, 0o664)
+        # No temporary files are left
+        self.assertEqual(sorted(os.listdir(os.path.dirname(self.typefile))), ['subtypes.txt', 'subtypes.txt.lock'])
+
+    def test_external_edit(self):
+        """ Changes made by others are picked up """
+        registry = subtypes.SubtypeRegistry()
+        changed = []
+        registry.on_change(changed.append)
+        registry.get('test')
+        with open(self.typefile + '.new', 'w') as typefile:
+            typefile.write('c\n')
+        os.replace(self.typefile + '.new', self.typefile)
+        self.assertEqual(registry.get('test'), ['c'])
+        self.assertEqual(changed, ['test'])
+
+    def test_concurrent(self):
+        """ Processes publishing at the same time do not lose each other's changes """
+        registry = subtypes.SubtypeRegistry()
+        registry.update(['old'], 'test')
+
+        def publish(worker):
+            own = subtypes.SubtypeRegistry()
+            # Never checks the file by itself, only when changing it
+            own.check_interval = 3600
+            own.get('test')
+            for ix in range(20):
+                own.add('{}-{}'.format(worker, ix), 'test')
+            own.remove('old', 'test')
+
+        context = multiprocessing.get_context('fork')
+        workers = [context.Process(target=publish, args=(worker,)) for worker in range(3)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        published = open(self.typefile).read().split('\n')
+        self.assertEqual(sorted(published), sorted('{}-{}'.format(w, ix) for w in range(3) for ix in range(20)))
+
+
+class TestCatalogue(unittest.TestCase):
+    def test_counts(self):
+        """ Counts from statlists in several languages are merged per subtype """
+        counts = {}
+        catalogue.add_counts(counts, 'sv', [['a', 3], ['b', 1], ['', 7]])
+        catalogue.add_counts(counts, 'fi', [['a', 2]])
+        subtype_catalogue = catalogue.Catalogue()
+        self.assertFalse(subtype_catalogue.has('test'))
+        subtype_catalogue.set('test', counts)
+        self.assertEqual(subtype_catalogue.subtypes('test'), {'a', 'b'})
+        self.assertEqual(subtype_catalogue.get_counts('test', ['a', 'c']), {'a': {'sv': 3, 'fi': 2}})
+        self.assertLess(subtype_catalogue.age('test'), 1)
+
+
+class TestExports(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        conf = {'export_dir': self.tmpdir.name}
+        patcher = configured(**conf)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def test_store(self):
+        """ Only the latest version is kept, and removed on unpublish """
+        first = exports.store('test', 'a b.c', 'sv', b'<div>1</div>')
+        second = exports.store('test', 'a b.c', 'sv', b'<div>2</div>')
+        exports.store('test', 'a b.c', 'fi', b'<div>3</div>')
+        self.assertNotEqual(first.digest, second.digest)
+        self.assertEqual(exports.find('test', 'a b.c', 'sv').path, second.path)
+        self.assertEqual(open(second.path, 'rb').read(), b'<div>2</div>')
+        exports.remove('test', 'a b.c')
+        self.assertIsNone(exports.find('test', 'a b.c', 'sv'))
+        self.assertEqual(os.listdir(exports.directory('test')), [])
+
+
+class TestConvert(unittest.TestCase):
+    objs = [{'baselang': {'form': [{'wordform': 'muminmamman'}],
+                          'compound': ['muminmammans väska']},
+             'targetlang': [{'form': [{'wordform': 'muumimamma', 'comment': '(ark.)'}],
+                             'compound': ['muumimamman laukku (ark.)']}],
+             'subtype': ['muminfigurer']}] * 3
+
+    def test_stream(self):
+        """ Streamed html is the same as the html converted in one go """
+        _, html = convert.termswefin(self.objs, css='style.css')
+        chunks = [convert.header('term-swefin', css='style.css'),
+                  convert.entries(self.objs[:2], 'term-swefin'),
+                  convert.entries(self.objs[2:], 'term-swefin'),
+                  convert.footer('term-swefin')]
+        self.assertEqual(''.join(chunks), html)
+        self.assertTrue(html.startswith('<!DOCTYPE html>'))
+        self.assertEqual(html.count('class="uppslag"'), 3)
+
+
+class TestProjection(unittest.TestCase):
+    def test_project(self):
+        """ Selected fields are kept, through lists """
+        obj = {'baselang': {'form': [{'wordform': 'mumin'}], 'compound': ['muminmamma']},
+               'targetlang': [{'form': [{'wordform': 'muumi'}], 'compound': ['muumimamma']}],
+               'subtype': ['muminfigurer']}
+        fields = projection.tree(projection.parse('baselang.form, targetlang.form.wordform,subtype,subtype.x'))
+        self.assertEqual(projection.project(obj, fields),
+                         {'baselang': {'form': [{'wordform': 'mumin'}]},
+                          'targetlang': [{'form': [{'wordform': 'muumi'}]}],
+                          'subtype': ['muminfigurer']})
+        with self.assertRaises(errors.QueryError):
+            projection.parse('baselang..form')
+
+
+class TestBatch(unittest.TestCase):
+    def test_parse(self):
+        """ Bad searches are reported one by one, bad batches as a whole """
+        body = {'searches': [{'id': 'a', 'mode': 'term-swefin', 'lang': 'xx'},
+                             {'mode': 'term-swefin', 'q': {'x': 1}}]}
+        batch = wordlists.Batch(json.dumps(body).encode())
+        self.assertEqual(list(batch.searches), ['a', '1'])
+        self.assertTrue(all(isinstance(search, errors.QueryError) for search in batch.searches.values()))
+        with self.assertRaises(errors.QueryError):
+            wordlists.Batch(json.dumps({'searches': [{'id': 'a'}, {'id': 'a'}]}).encode())
+        with self.assertRaises(errors.QueryError):
+            wordlists.Batch(b'[]')
+
+
+class TestPdf(unittest.TestCase):
+    def test_export(self):
+        """ Entries are laid out on several pages, and the file's index points to the objects """
+        obj = {'baselang': {'form': [{'wordform': 'mumin'}], 'compound': ['muminmamma']},
+               'targetlang': [{'form': [{'wordform': 'muumi', 'comment': '(ark.)'}],
+                               'compound': ['muumimamma']}],
+               'subtype': ['muminfigurer']}
+        data = convert.pdf_export([obj] * 100, 'term-swefin')
+        self.assertTrue(data.startswith(b'%PDF-1.4') and data.endswith(b'%%EOF\n'))
+        pages = data.count(b'/Type /Page ')
+        self.assertGreater(pages, 1)
+        self.assertIn('/Count {}'.format(pages).encode(), data)
+        xref = int(re.search(rb'startxref\n(\d+)', data).group(1))
+        self.assertTrue(data[xref:].startswith(b'xref\n0 '))
+        size = int(re.match(rb'xref\n0 (\d+)', data[xref:]).group(1))
+        self.assertIn('/Size {}'.format(size).encode(), data[xref:])
+        offsets = re.findall(rb'(\d{10}) 00000 n', data[xref:])
+        self.assertEqual(len(offsets), size - 1)
+        self.assertEqual(len(re.findall(rb'\n\d+ 0 obj', data)), size - 1)
+        for number, offset in enumerate(offsets, 1):
+            self.assertTrue(data[int(offset):].startswith('{} 0 obj'.format(number).encode()))
+
+    def test_unsupported_mode(self):
+        """ Modes whose script the pdf fonts cannot write have no pdf export """
+        self.assertNotIn('term-sweyid', convert.mode_pdf)
+        configs = dict(settings.configs, yid=settings.ModeConfig('yid', dict(settings.config().values,
+                                                                             mode='term-sweyid')))
+        with mock.patch('conf.settings.configs', configs), \
+             mock.patch('conf.settings.modes', settings.modes | {'yid'}):
+            with self.assertRaises(errors.QueryError):
+                wordlists.Search({'mode': 'yid', 'format': 'pdf'}.get)
+
+
+class TestWorkerPool(AsyncTestCase):
+    def test_busy(self):
+        """ Jobs beyond the workers and the queue are refused """
+        pool = workers.WorkerPool('test', 1, 1, 5)
+        with pool.slot(), pool.slot():
+            with self.assertRaises(errors.BusyError) as busy:
+                with pool.slot():
+                    pass
+        self.assertEqual(busy.exception.retry_after, 5)
+        self.assertEqual(pool.stats(), {'workers': 1, 'pending': 0, 'rejected': 1})
+
+    @gen_test
+    async def test_run(self):
+        """ Jobs run in the workers, and are timed """
+        pool = workers.WorkerPool('test', 2, 1, 5, kind='thread')
+        self.addCleanup(pool.shutdown)
+        html = await pool.run(convert.entries, [], 'term-swefin')
+        self.assertEqual(html, '')
+        self.assertEqual(metrics.histograms['worker_run_seconds'][(('pool', 'test'),)].count, 1)
+
+
+class TestPaging(AsyncTestCase):
+    @gen_test
+    async def test_pages(self):
+        """ A big export is fetched in windows, and returned in order """
+        calls = []
+
+        async def call(path, params, mode, timeout=None):
+            calls.append((params['start'], params['size']))
+            end = min(params['start'] + params['size'], 23)
+            hits = [{'_source': n} for n in range(params['start'], end)]
+            return {'hits': {'total': 23, 'hits': hits}}
+
+        conf = {'export_pagesize': 5, 'export_concurrency': 2, 'karp_export_timeout': 1}
+        with mock.patch('utils.karp.call', call), \
+             configured(**conf):
+            hits = []
+            async for page in wordlists.fetch_pages({'size': 100}, 'test'):
+                hits.extend(hit['_source'] for hit in page)
+        self.assertEqual(hits, list(range(23)))
+        self.assertEqual(sorted(calls), [(0, 5), (5, 5), (10, 5), (15, 5), (20, 3)])
+
+
+class TestFakeKarpPaging(AsyncHTTPTestCase):
+    def get_app(self):
+        app = fakekarp.make_app(0, 0)
+        entries = fakekarp.make_entries(157)
+        # Many entries with the same form, ordered by the tiebreaker
+        for entry in entries[::2]:
+            entry['_source']['baselang']['form'][0]['wordform'] = 'samma'
+        app.settings['lexicon'] = fakekarp.Lexicon(entries)
+        return app
+
+    def test_windows(self):
+        """ Windows fetched at the same time join up, without duplicates or gaps """
+        conf = {'export_pagesize': 10, 'export_concurrency': 3, 'karp_export_timeout': 5,
+                'karp_connect_timeout': 5, 'username': 'user', 'password': 'pass'}
+        params = {'resource': 'test', 'mode': 'test', 'size': 1000, 'sort': 'baseform.sort,_id',
+                  'q': 'extended||and|baseform.searchraw|regexp|.*'}
+
+        async def fetch_all():
+            hits = []
+            async for page in wordlists.fetch_pages(params, 'test'):
+                hits.extend(hit['_id'] for hit in page)
+            return hits
+
+        with mock.patch('conf.settings.karp', self.get_url('')), \
+             configured(**conf):
+            hits = self.io_loop.run_sync(fetch_all)
+        expected = [entry['_id'] for entry in self._app.settings['lexicon'].by_source]
+        self.assertEqual(hits, expected)
+        self.assertEqual(len(set(hits)), 157)
+
+
+class TestMirrorDownload(AsyncTestCase):
+    @gen_test
+    async def test_too_big(self):
+        """ A wordlist bigger than mirror_maxsize is not mirrored """
+        calls = []
+
+        async def call(path, params, mode, timeout=None):
+            calls.append(params)
+            hits = [{'_id': str(n), '_source': {}} for n in range(params['size'])]
+            return {'hits': {'total': 12, 'hits': hits}}
+
+        conf = {'export_pagesize': 5, 'export_concurrency': 2, 'karp_export_timeout': 1,
+                'mirror_maxsize': 10, 'resource': 'test', 'mode': 'test', 'sourcelanguage': 'sv'}
+        mirror.mirrors['test'] = 'stale'
+        with mock.patch('utils.karp.call', call), \
+             configured(**conf), \
+             mock.patch('utils.wordlists.build_query', lambda *args: 'q'), \
+             mock.patch('utils.wordlists.sort_order', lambda source, mode: 'sort'), \
+             mock.patch.object(subtypes.registry, 'get', lambda mode: ['a']), \
+             mock.patch.object(subtypes.registry, 'version', lambda mode: 1):
+            await wordlists.refresh_mirror('test')
+        self.assertNotIn('test', mirror.mirrors)
+        self.assertEqual(len(calls), 1)
+
+
+class TestMirror(unittest.TestCase):
+    def hit(self, _id, base, target, subtype):
+        return {'_id': _id,
+                '_source': {'baselang': {'form': [{'wordform': base}]},
+                            'targetlang': [{'form': [{'wordform': target}]}],
+                            'subtype': [subtype]}}
+
+    def setUp(self):
+        hits = [self.hit('1', 'Apa', 'apina', 'djur'),
+                self.hit('2', 'apelsin', 'appelsiini', 'frukt'),
+                self.hit('3', 'banan', 'banaani', 'frukt'),
+                self.hit('4', 'björn', 'karhu', 'djur')]
+        self.mirror = mirror.Mirror('test', hits, ['1', '2', '3', '4'][::-1], ngram_budget=10000)
+
+    def test_prefix(self):
+        """ Prefix search is case insensitive and restricted to the subtypes """
+        total, entries = self.mirror.search('ap', ['djur', 'frukt'], True, 10)
+        self.assertEqual(total, 2)
+        total, entries = self.mirror.search('AP', ['djur'], True, 10)
+        self.assertEqual([e['baselang']['form'][0]['wordform'] for e in entries], ['Apa'])
+        total, entries = self.mirror.search('kar', ['djur'], False, 10)
+        self.assertEqual(total, 1)
+
+    def test_contains(self):
+        """ Substring search uses the trigram index, also for short words """
+        total, entries = self.mirror.search('nan', ['frukt'], True, 10, contains=True)
+        self.assertEqual(total, 1)
+        total, entries = self.mirror.search('in', ['djur', 'frukt'], False, 10, contains=True)
+        self.assertEqual(total, 2)
+        total, entries = self.mirror.search('xyz', ['djur', 'frukt'], True, 10, contains=True)
+        self.assertEqual(total, 0)
+
+    def test_browse(self):
+        """ Browsing is sorted by the requested language and limited in size """
+        total, entries = self.mirror.search('', ['djur', 'frukt'], True, 3)
+        self.assertEqual(total, 4)
+        self.assertEqual([e['subtype'] for e in entries], [['djur'], ['frukt'], ['frukt']])
+        total, entries = self.mirror.search('', ['djur', 'frukt'], False, 1)
+        self.assertEqual(entries[0]['baselang']['form'][0]['wordform'], 'björn')
+
+    def test_page(self):
+        """ Pages continue after the sort key of the previous page """
+        words = []
+        after = None
+        while True:
+            total, entries, after = self.mirror.page('', ['djur', 'frukt'], False, 3, after=after)
+            words.extend(e['baselang']['form'][0]['wordform'] for e in entries)
+            if after is None:
+                break
+        self.assertEqual(words, ['björn', 'banan', 'apelsin', 'Apa'])
+        total, entries, after = self.mirror.page('', ['djur', 'frukt'], False, 3, start=3)
+        self.assertEqual((len(entries), after), (1, None))
+
+
+class TestCursor(unittest.TestCase):
+    def test_roundtrip(self):
+        """ Cursors only work for the search they were made for """
+        query = cursor.query_key('test', {'q': 'extended||and|x|startswith|a'})
+        token = cursor.encode(query, 25, [3, 7], 1234)
+        self.assertEqual(cursor.decode(token, query), {'start': 25, 'after': [3, 7], 'mirror': 1234})
+        other = cursor.query_key('test', {'q': 'extended||and|x|startswith|b'})
+        with self.assertRaises(errors.QueryError):
+            cursor.decode(token, other)
+        with self.assertRaises(errors.QueryError):
+            cursor.decode('not a cursor', query)
+
+
+class TestSingleFlight(AsyncTestCase):
+    @gen_test
+    async def test_coalesce(self):
+        """ Concurrent identical calls share one call """
+        calls = []
+
+        async def func():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return {'hits': {}}
+
+        flight = cache.SingleFlight('test')
+        results = await asyncio.gather(*[flight.do('key', func) for _ in range(5)])
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(result is results[0] for result in results))
+        self.assertEqual(flight.stats()['coalesced'], 4)
+        await flight.do('key', func)
+        self.assertEqual(len(calls), 2)
+
+
+class TestKarp(AsyncTestCase):
+    @gen_test
+    async def test_not_json(self):
+        """ An error page instead of json is a Karp error """
+        async def fetch(url, mode, headers=None, timeout=None):
+            return mock.Mock(body=b'<html>502 Bad Gateway</html>')
+
+        with mock.patch('utils.karp.fetch', fetch), \
+             mock.patch('utils.karp.credentials', lambda mode: 'Basic x'):
+            with self.assertRaises(errors.KarpError):
+                await karp.call('query', {}, 'test')
+
+
+class TestSettings(unittest.TestCase):
+    def test_compile(self):
+        """ The settings of a mode are resolved in the right order, and read only """
+        conf = {'default': {'maxsize': 10}, 'a': {'maxsize': 20}}
+        default_conf = {'default': {'maxsize': 1, 'css': 'x', 'baseform.search': 'f'},
+                        'a': {'css': 'y', 'languages': ['sv']}, 'b': {}}
+        modes, configs = settings.compile_configs(conf, default_conf)
+        self.assertEqual(modes, {'a', 'b'})
+        self.assertEqual(configs['a'].maxsize, 20)
+        self.assertEqual(configs['b'].maxsize, 10)
+        self.assertEqual(configs['a'].css, 'y')
+        self.assertEqual(configs['b'].baseform_search, 'f')
+        self.assertEqual(configs['a'].get('languages'), ('sv',))
+        self.assertRaises(AttributeError, setattr, configs['a'], 'maxsize', 1)
+
+    def test_changed(self):
+        """ Edited settings files are noticed """
+        with mock.patch('conf.settings.loaded', settings.stamps()):
+            self.assertFalse(settings.changed())
+        with mock.patch('conf.settings.loaded', [None, None]):
+            self.assertTrue(settings.changed())
+
+
+class TestMetrics(unittest.TestCase):
+    def test_timings(self):
+        """ Phases are summed up in the Server-Timing header and in the histograms """
+        timings = metrics.Timings()
+        timings.add('karp', 0.002)
+        timings.add('karp', 0.003)
+        self.assertEqual(timings.header(), 'karp;dur=5.00')
+        text = metrics.render([('cache_size', 'gauge', {'cache': 'a'}, 1),
+                               ('cache_hits_total', 'counter', {'cache': 'a'}, 2),
+                               ('cache_size', 'gauge', {'cache': 'b'}, 3)])
+        self.assertIn('phase_seconds_bucket{phase="karp",le="0.0025"}', text)
+        self.assertIn('cache_size{cache="a"} 1\ncache_size{cache="b"} 3', text)
+
+
+class TestCompression(unittest.TestCase):
+    def test_choose(self):
+        self.assertEqual(compression.choose('gzip, deflate'), 'gzip')
+        self.assertEqual(compression.choose('gzip;q=0, deflate'), None)
+        self.assertEqual(compression.choose(''), None)
+
+    def test_stream(self):
+        """ A stream compressed chunk by chunk is one valid gzip file """
+        compressor = compression.Compressor('gzip')
+        chunks = [b'<div>' * 100, b'</div>' * 100, b'']
+        data = b''.join(compressor.compress(chunk, ix == len(chunks) - 1)
+                        for ix, chunk in enumerate(chunks))
+        self.assertEqual(gzip.decompress(data), b''.join(chunks))
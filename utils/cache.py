@@ -0,0 +1,179 @@
+""" In-process caches """
+import asyncio
+import collections
+import logging
+import sys
+import time
+
+
+class LRUCache(object):
+    """ A bounded cache, evicting the least recently used entries.
+        Every entry has its own time to live (in seconds).
+        Keys are tuples where the first element is the mode, so that
+        everything belonging to one mode can be dropped at once.
+        If `maxbytes` is given, entries are also evicted to keep the total
+        of the sizes given to `set` and `grow` below it.
+    """
+
+    def __init__(self, name, maxsize, maxbytes=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.entries = collections.OrderedDict()
+        self.sizes = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """ Return the cached value, or None if missing or expired """
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self.remove(key)
+        self.misses += 1
+        return None
+
+    def set(self, key, value, ttl, size=0):
+        """ Store a value of `size` bytes for `ttl` seconds """
+        if self.maxsize <= 0 or ttl <= 0:
+            return
+        if self.maxbytes is not None and size > self.maxbytes:
+            return
+        self.remove(key)
+        self.entries[key] = (time.monotonic() + ttl, value)
+        self.sizes[key] = size
+        self.bytes += size
+        self.evict()
+
+    def grow(self, key, size):
+        """ Count `size` more bytes for an entry, whose value has grown """
+        if key in self.entries:
+            self.sizes[key] += size
+            self.bytes += size
+            self.entries.move_to_end(key)
+            self.evict()
+
+    def evict(self):
+        while self.entries and (len(self.entries) > self.maxsize or
+                                (self.maxbytes is not None and self.bytes > self.maxbytes)):
+            self.remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def remove(self, key):
+        if key in self.entries:
+            del self.entries[key]
+            self.bytes -= self.sizes.pop(key)
+
+    def invalidate(self, mode):
+        """ Drop all entries for a mode """
+        keys = [key for key in self.entries if key[0] == mode]
+        for key in keys:
+            self.remove(key)
+        logging.debug('%s: dropped %s entries for %s', self.name, len(keys), mode)
+
+    def clear(self):
+        self.entries.clear()
+        self.sizes.clear()
+        self.bytes = 0
+
+    def stats(self):
+        """ Hit and miss counters """
+        return {'size': len(self.entries),
+                'bytes': self.bytes,
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+
+class FragmentCache(object):
+    """ Rendered pieces of text (or bytes), bounded by their total size (in bytes),
+        evicting the least recently used.
+        Each piece is stored with a digest of what it was made from, and is
+        only returned for the same digest.
+    """
+    # Rough memory use of an entry, besides the text
+    OVERHEAD = 200
+
+    def __init__(self, name, maxbytes):
+        self.name = name
+        self.maxbytes = maxbytes
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, digest):
+        """ Return the text made from `digest`, or None """
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == digest:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def set(self, key, digest, text):
+        """ Store a text, replacing the one made from an older version """
+        size = sys.getsizeof(text) + self.OVERHEAD
+        if size > self.maxbytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old[2]
+        self.entries[key] = (digest, text, size)
+        self.bytes += size
+        while self.bytes > self.maxbytes:
+            _, (_, _, oldsize) = self.entries.popitem(last=False)
+            self.bytes -= oldsize
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        """ Hit and miss counters, and memory use """
+        lookups = self.hits + self.misses
+        return {'size': len(self.entries),
+                'bytes': self.bytes,
+                'maxbytes': self.maxbytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions}
+
+
+class SingleFlight(object):
+    """ Lets concurrent calls with the same key share one call, and its result """
+
+    def __init__(self, name):
+        self.name = name
+        self.inflight = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key, func):
+        """ Await `func()`, unless an identical call is already running """
+        future = self.inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+        else:
+            self.calls += 1
+            future = asyncio.ensure_future(func())
+            self.inflight[key] = future
+            future.add_done_callback(lambda _: self.inflight.pop(key, None))
+        # One caller giving up must not cancel the call for the others
+        return await asyncio.shield(future)
+
+    def stats(self):
+        return {'inflight': len(self.inflight),
+                'calls': self.calls,
+                'coalesced': self.coalesced}
@@ -0,0 +1,53 @@
+""" All subtypes in Karp, with the number of entries in each """
+import time
+
+
+class Catalogue(object):
+    """ The subtypes of each mode, and how many entries they have per
+        language, as counted when the mode was last refreshed.
+    """
+
+    def __init__(self):
+        # mode -> subtype -> language -> number of entries
+        self.counts = {}
+        # mode -> time of the last refresh
+        self.refreshed = {}
+
+    def set(self, mode, counts):
+        self.counts[mode] = counts
+        self.refreshed[mode] = time.time()
+
+    def has(self, mode):
+        return mode in self.counts
+
+    def subtypes(self, mode):
+        """ All subtypes of the mode, empty if it has not been loaded """
+        return set(self.counts.get(mode, {}))
+
+    def get_counts(self, mode, subtypes):
+        """ The number of entries per language of the subtypes.
+            Subtypes that are not in the catalogue are left out.
+        """
+        counts = self.counts.get(mode, {})
+        return {subtype: counts[subtype] for subtype in subtypes if subtype in counts}
+
+    def age(self, mode):
+        """ Seconds since the mode was refreshed, or None if it never was """
+        if mode not in self.refreshed:
+            return None
+        return time.time() - self.refreshed[mode]
+
+    def clear(self):
+        self.counts.clear()
+        self.refreshed.clear()
+
+
+def add_counts(counts, lang, stat_table):
+    """ Add the counts of a Karp statlist over subtypes, made in `lang`,
+        to `counts` (subtype -> language -> number of entries)
+    """
+    for row in stat_table:
+        subtype, count = row[0], row[-1]
+        if subtype:
+            counts.setdefault(subtype, {})[lang] = int(count)
+    return counts
@@ -0,0 +1,98 @@
+""" Compression of responses: gzip, and brotli if it is installed """
+import zlib
+
+import tornado.web
+
+import conf.settings as settings
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Only these responses are compressed
+PATHS = ('/search', '/search/batch')
+CONTENT_TYPES = ('text/html', 'text/plain', 'application/json', 'application/x-ndjson')
+# Fast enough to compress while streaming (brotli's default, 11, is much slower)
+BROTLI_QUALITY = 5
+GZIP_LEVEL = 6
+
+
+def choose(accept_encoding):
+    """ The best encoding accepted by the client, or None """
+    accepted = set()
+    for part in accept_encoding.split(','):
+        fields = part.strip().split(';')
+        if any(field.strip() in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000') for field in fields[1:]):
+            continue
+        accepted.add(fields[0].strip().lower())
+    if brotli is not None and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return None
+
+
+class Compressor(object):
+    """ Compress a stream of chunks """
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == 'br':
+            self.compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, chunk, finishing):
+        """ Compress a chunk. Everything given so far can be decompressed by the client. """
+        if self.encoding == 'br':
+            data = self.compressor.process(chunk)
+            return data + (self.compressor.finish() if finishing else self.compressor.flush())
+        data = self.compressor.compress(chunk)
+        return data + self.compressor.flush(zlib.Z_FINISH if finishing else zlib.Z_SYNC_FLUSH)
+
+
+def compress(data, encoding):
+    """ Compress a complete response """
+    return Compressor(encoding).compress(data, True)
+
+
+class CompressionTransform(tornado.web.OutputTransform):
+    """ Compress search results with the best encoding the client accepts.
+        Responses known to be shorter than `compress_min_length` are sent
+        as they are, and so are responses that are already compressed.
+    """
+
+    def __init__(self, request):
+        self.compressor = None
+        self.path_ok = request.path in PATHS
+        self.encoding = None
+        if self.path_ok:
+            self.encoding = choose(request.headers.get('Accept-Encoding', ''))
+
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        if not self.path_ok:
+            return status_code, headers, chunk
+        if 'Vary' in headers:
+            headers['Vary'] += ', Accept-Encoding'
+        else:
+            headers['Vary'] = 'Accept-Encoding'
+        content_type = headers.get('Content-Type', '').split(';')[0]
+        if (self.encoding and status_code not in (204, 304)
+                and content_type in CONTENT_TYPES
+                and 'Content-Encoding' not in headers
+                and not (finishing and len(chunk) < settings.config().compress_min_length)):
+            headers['Content-Encoding'] = self.encoding
+            self.compressor = Compressor(self.encoding)
+            chunk = self.transform_chunk(chunk, finishing)
+            if 'Content-Length' in headers:
+                if finishing:
+                    headers['Content-Length'] = str(len(chunk))
+                else:
+                    del headers['Content-Length']
+        return status_code, headers, chunk
+
+    def transform_chunk(self, chunk, finishing):
+        if self.compressor is not None:
+            chunk = self.compressor.compress(chunk, finishing)
+        return chunk
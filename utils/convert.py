@@ -4,6 +4,8 @@ import logging
 import re
 import xml.etree.ElementTree as etree
 
+import utils.pdf as pdf
+
 
 def format_posts(ans, mode, toformat='html', css=''):
     " Helper for formatting a search result "
@@ -14,8 +16,54 @@ def format_posts(ans, mode, toformat='html', css=''):
     return tab
 
 
+def header(mode, css=''):
+    " The beginning of an html document "
+    if mode not in mode_stream:
+        return default([], 'html')[1]
+    return mode_stream[mode][0](css)
+
+
+def entries(objs, mode):
+    " The html of a list of entries "
+    if mode not in mode_stream:
+        return ''
+    entry = mode_stream[mode][1]
+    return ''.join(entry(obj) for obj in objs)
+
+
+def fragments(objs, mode):
+    " The html of each entry in a list, separately "
+    if mode not in mode_stream:
+        return ['' for obj in objs]
+    entry = mode_stream[mode][1]
+    return [entry(obj) for obj in objs]
+
+
+def footer(mode):
+    " The end of an html document "
+    if mode not in mode_stream:
+        return ''
+    return HTML_FOOTER
+
+
 def termswefin(objs, css=''):
-    """ Converts a list of term-swefin objects to HTML.
+    """ Converts a list of term-swefin objects to HTML. """
+    html = [termswefin_header(css)]
+    if objs:
+        logging.debug('will format, start with %s', objs[0])
+    html.extend(termswefin_entry(obj) for obj in objs)
+    html.append(HTML_FOOTER)
+    return len(objs), ''.join(html)
+
+
+# Closes the document started by the header functions
+HTML_FOOTER = '</div></body></html>'
+TERMSWEFIN_TITLE = 'Sverigefinska ordlistor från Språkrådet'
+
+
+def termswefin_header(css=''):
+    """ The HTML header for term-swefin, ending with the opening of the
+        main div, where the entries go.
         The HTML header and the CSS template are written by
         Eva Lindström (evali@ling.su) and
         Gunnar Eriksson (gunnar.eriksson@sprakochfolkminnen.se)
@@ -43,75 +91,115 @@ def termswefin(objs, css=''):
     body = etree.SubElement(doc, 'body')
     # Don't use title
     # title = etree.SubElement(body, 'div', {"class": "title clearfix"})
-    # titles = set()
-    if objs:
-        logging.debug('will format, start with %s', objs[0])
-    main = etree.SubElement(body, 'div', {"class": "main"})
-    for obj in objs:
-        # make one html entry for every subtype (sakområde)
-        for subtype in obj.get('subtype', ["-"]):
-            #titles.add(subtype.title())
-            uppslag = etree.SubElement(main, 'div', {"class": "uppslag"})
-            p = etree.SubElement(uppslag, 'p', {"class": "lex"})
-            lexem = etree.SubElement(p, 'span', {"class": "lexem"})
-            lexem.text = escape(obj['baselang'].get('form')[0].get('wordform'))
-            trans = etree.SubElement(p, 'span', {"class": "comm-sv"})
-            trans.text = escape(obj['baselang'].get('form')[0].get('comment', ''))
-            # TODO ';' (separating forms/comments) not implemented
-            for target in obj.get('targetlang'):
-                num_tform = len(target.get('form', []))
-                for ix, tform in enumerate(target.get('form', [])):
-                    comm = escape(tform.get('comment', ''), tail=False)
-                    form = escape(tform.get('wordform', ''), tail=comm)
-                    trans = etree.SubElement(p, 'span', {"class": "fi_trans", "lang": "fi"})
-                    trans.text = form
-                    last = trans
-                    if comm:
-                        transcomm = etree.SubElement(p, 'span', {"class": "comm"})
-                        transcomm.text = comm
-                        last = transcomm
-                    # find out whether a comma should be appended
-                    if ix < num_tform-1:
-                        last.tail = ', '
-                    else:
-                        last.tail = ' '
-
-            # create html for "sammansättningar"
-            subupp = etree.SubElement(uppslag, 'div', {"class": "uppslag_sub"})
-            for i, ex in enumerate(obj.get('baselang').get('compound', [])):
-                lex_sub = etree.SubElement(subupp, 'p', {"class": "lex_sub"})
-                dash = etree.SubElement(lex_sub, 'span', {"class": "dash"})
-                dash.text = u'– '  # other dash version: u'— '
-                lexem_sub = etree.SubElement(lex_sub, 'span', {"class": "lexem_sub"})
-                # TODO future, when field structure is improved
-                # comm = escape(ex.get('comment', ''), tail=False)
-                # form = escape(ex.get('form', ''), tail=comm)
-                lexem_sub.text = escape(ex)
-                try:
-                    target = escape(obj.get('targetlang', [{}])[0].get('compound')[i])
-                    # Put tags around span with 'comm' class around "(ark.)"
-                    if '(ark.)' in target:
-                        target = re.sub(r'(\(ark\.\))', r'<span class="comm">\1</span>', target)
-
-                    # TODO future, when field structure is improved
-                    # targetcomm = escape(target.get('comment', ''), tail=False)
-                    # targetform = escape(target.get('form', ''), tail=comm)
-                except IndexError:
-                    # The json format does not guarantee that there are enough
-                    # subemma translations. Just leave the field blank, in that case.
-                    target = ''
-                if target:
-                    # Cannot use proper etree handling here, since we manually
-                    # insert tags around (ark.).
-                    target = u'<span class="fi_trans_sub" lang="fi">' + target + u'</span>'
-                    lex_sub.append(etree.fromstring(target.encode('utf8')))
-
-    # etree.SubElement(title, 'h1').text = ', '.join(titles)
+    etree.SubElement(body, 'div', {"class": "main"})
     root = etree.tostring(doc, method="html", encoding='unicode')
-    logging.debug(root)
-    logging.debug(type(root))
-    root = '<!DOCTYPE html>\n' + root
-    return len(objs), root #.encode('utf8')
+    # Cut the document where the entries should be inserted
+    root = root[:-len(HTML_FOOTER)]
+    return '<!DOCTYPE html>\n' + root
+
+
+def termswefin_entry(obj):
+    """ Converts one term-swefin object to HTML """
+    html = []
+    # make one html entry for every subtype (sakområde)
+    for subtype in obj.get('subtype', ["-"]):
+        uppslag = etree.Element('div', {"class": "uppslag"})
+        p = etree.SubElement(uppslag, 'p', {"class": "lex"})
+        lexem = etree.SubElement(p, 'span', {"class": "lexem"})
+        lexem.text = escape(obj['baselang'].get('form')[0].get('wordform'))
+        trans = etree.SubElement(p, 'span', {"class": "comm-sv"})
+        trans.text = escape(obj['baselang'].get('form')[0].get('comment', ''))
+        # TODO ';' (separating forms/comments) not implemented
+        for target in obj.get('targetlang'):
+            num_tform = len(target.get('form', []))
+            for ix, tform in enumerate(target.get('form', [])):
+                comm = escape(tform.get('comment', ''), tail=False)
+                form = escape(tform.get('wordform', ''), tail=comm)
+                trans = etree.SubElement(p, 'span', {"class": "fi_trans", "lang": "fi"})
+                trans.text = form
+                last = trans
+                if comm:
+                    transcomm = etree.SubElement(p, 'span', {"class": "comm"})
+                    transcomm.text = comm
+                    last = transcomm
+                # find out whether a comma should be appended
+                if ix < num_tform-1:
+                    last.tail = ', '
+                else:
+                    last.tail = ' '
+
+        # create html for "sammansättningar"
+        subupp = etree.SubElement(uppslag, 'div', {"class": "uppslag_sub"})
+        for i, ex in enumerate(obj.get('baselang').get('compound', [])):
+            lex_sub = etree.SubElement(subupp, 'p', {"class": "lex_sub"})
+            dash = etree.SubElement(lex_sub, 'span', {"class": "dash"})
+            dash.text = u'– '  # other dash version: u'— '
+            lexem_sub = etree.SubElement(lex_sub, 'span', {"class": "lexem_sub"})
+            # TODO future, when field structure is improved
+            # comm = escape(ex.get('comment', ''), tail=False)
+            # form = escape(ex.get('form', ''), tail=comm)
+            lexem_sub.text = escape(ex)
+            try:
+                target = escape(obj.get('targetlang', [{}])[0].get('compound')[i])
+                # Put tags around span with 'comm' class around "(ark.)"
+                if '(ark.)' in target:
+                    target = re.sub(r'(\(ark\.\))', r'<span class="comm">\1</span>', target)
+
+                # TODO future, when field structure is improved
+                # targetcomm = escape(target.get('comment', ''), tail=False)
+                # targetform = escape(target.get('form', ''), tail=comm)
+            except IndexError:
+                # The json format does not guarantee that there are enough
+                # subemma translations. Just leave the field blank, in that case.
+                target = ''
+            if target:
+                # Cannot use proper etree handling here, since we manually
+                # insert tags around (ark.).
+                target = u'<span class="fi_trans_sub" lang="fi">' + target + u'</span>'
+                lex_sub.append(etree.fromstring(target.encode('utf8')))
+        html.append(etree.tostring(uppslag, method="html", encoding='unicode'))
+    return ''.join(html)
+
+
+def pdf_export(objs, mode):
+    """ Converts a list of objects to a pdf document (as bytes).
+        Run in a worker process, as big documents take a while.
+    """
+    title, entry = mode_pdf.get(mode, ('', None))
+    doc = pdf.Document(title)
+    if entry is not None:
+        for obj in objs:
+            entry(doc, obj)
+    return doc.render()
+
+
+def termswefin_pdf_entry(doc, obj):
+    """ Adds one term-swefin object to a pdf document, laid out like the html """
+    # one entry for every subtype (sakområde)
+    for subtype in obj.get('subtype', ["-"]):
+        base = obj['baselang'].get('form')[0]
+        runs = [('bold', escape(base.get('wordform')))]
+        if base.get('comment', '').strip():
+            runs.append(('regular', escape(base.get('comment'))))
+        for target in obj.get('targetlang'):
+            num_tform = len(target.get('form', []))
+            for ix, tform in enumerate(target.get('form', [])):
+                comm = escape(tform.get('comment', ''), tail=False)
+                runs.append(('regular', escape(tform.get('wordform', ''), tail=comm)))
+                if comm:
+                    runs.append(('italic', comm))
+                runs.append(('regular', ', ' if ix < num_tform-1 else ' '))
+        doc.paragraph(runs, space_before=4)
+
+        # "sammansättningar"
+        for i, ex in enumerate(obj.get('baselang').get('compound', [])):
+            runs = [('regular', u'– '), ('bold', escape(ex))]
+            try:
+                runs.append(('regular', escape(obj.get('targetlang', [{}])[0].get('compound')[i])))
+            except IndexError:
+                # Not enough subemma translations, leave it blank
+                pass
+            doc.paragraph(runs, indent=12)
 
 
 def escape(string, tail=True):
@@ -130,3 +218,14 @@ mode_conv = {"term-swefin": termswefin,
              # For now, use swef-fin.
              "term-sweyid": termswefin,
             }
+
+# Header and entry converters, for exporting piece by piece
+mode_stream = {"term-swefin": (termswefin_header, termswefin_entry),
+               "term-sweyid": (termswefin_header, termswefin_entry),
+              }
+
+# Titles and entry converters for pdf documents.
+# The pdf fonts only have the Latin characters of cp1252, so term-sweyid
+# (Hebrew script) cannot be written.
+mode_pdf = {"term-swefin": (TERMSWEFIN_TITLE, termswefin_pdf_entry),
+           }
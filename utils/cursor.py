@@ -0,0 +1,38 @@
+""" Opaque tokens pointing to the next page of a paginated search """
+import base64
+import binascii
+import hashlib
+import json
+
+import utils.errors as errors
+
+# The position of the first page
+START = {'start': 0, 'after': None, 'mirror': None}
+
+
+def query_key(mode, params):
+    """ Identifies the search (but not the page size) a cursor belongs to """
+    query = [mode, params['q'], params.get('sort', ''), params.get('show', '')]
+    return hashlib.sha1(json.dumps(query).encode()).hexdigest()[:12]
+
+
+def encode(query, start, after=None, mirror=None):
+    """ A cursor to the hits after the first `start` hits.
+        `after` is the sort key of the last hit in the mirror with version `mirror`.
+    """
+    position = {'q': query, 's': start, 'a': after, 'm': mirror}
+    data = json.dumps(position, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def decode(token, query):
+    """ The position stored in a cursor, as a dict like START """
+    try:
+        data = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        position = json.loads(data.decode())
+        start, after, mirror = int(position['s']), position['a'], position['m']
+        if position['q'] != query or start < 0:
+            raise errors.QueryError('The cursor belongs to another search')
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError, KeyError):
+        raise errors.QueryError('Bad cursor')
+    return {'start': start, 'after': after, 'mirror': mirror}
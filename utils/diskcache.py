@@ -0,0 +1,247 @@
+""" Karp results kept on disk, so that they survive restarts """
+import json
+import logging
+import os
+import sqlite3
+import time
+import zlib
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    mode TEXT NOT NULL,
+    version TEXT NOT NULL,
+    expires REAL NOT NULL,
+    used REAL NOT NULL,
+    value BLOB NOT NULL
+)
+'''
+# Seconds the IOLoop waits for a database locked by another process,
+# before giving up the read or write
+BUSY_TIMEOUT = 0.05
+# Seconds compaction (in a thread) waits for the database
+COMPACT_TIMEOUT = 10
+# The file may grow to this many times `maxbytes` between compactions
+HARD_LIMIT = 2
+
+
+class DiskCache(object):
+    """ Decoded Karp results in an SQLite database, shared by all worker
+        processes and kept between restarts.
+        Every result is stored with the version of the published subtypes
+        of its mode, and is only returned for the same version.
+        The database is opened when first used, after the workers are forked.
+        Reads and writes are made on the IOLoop, and give up at once if the
+        database is locked. `compact` (run in a thread, with a connection of
+        its own) drops expired and outdated results, and the least recently
+        used ones until the file takes at most `maxbytes`.
+        Errors from the database are logged and treated as misses.
+    """
+
+    def __init__(self, name, path, maxbytes):
+        self.name = name
+        self.path = path
+        self.maxbytes = maxbytes
+        self.db = None
+        # key -> time, when results were last read, saved by `save_used` or `compact`
+        self.used = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.skipped = 0
+
+    def enabled(self):
+        return self.maxbytes > 0
+
+    def open(self, timeout):
+        """ A new connection to the database, created if needed """
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        db = sqlite3.connect(self.path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        # Only has effect before the file is initialised, which switching to WAL does.
+        # Lets compact() return space to the disk.
+        db.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        # Lets the workers read while one of them writes
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute(SCHEMA)
+        return db
+
+    def connect(self):
+        """ The connection used on the IOLoop, which may not grow the file
+            past `HARD_LIMIT` times `maxbytes`
+        """
+        if self.db is None:
+            db = self.open(BUSY_TIMEOUT)
+            page_size = db.execute('PRAGMA page_size').fetchone()[0]
+            db.execute('PRAGMA max_page_count={}'.format(max(HARD_LIMIT * self.maxbytes // page_size, 1)))
+            self.db = db
+        return self.db
+
+    @staticmethod
+    def key(key):
+        return json.dumps(key, separators=(',', ':'))
+
+    def get(self, key, version, with_size=False):
+        """ Return the cached result, or None if missing, expired or made
+            for another version of the subtypes.
+            With `with_size`, return it with the length of its json, or (None, 0).
+        """
+        if not self.enabled():
+            return (None, 0) if with_size else None
+        try:
+            now = time.time()
+            row = self.connect().execute('SELECT value FROM results WHERE key = ? AND version = ? AND expires > ?',
+                                         (self.key(key), version, now)).fetchone()
+            if row is not None:
+                self.used[self.key(key)] = now
+                self.hits += 1
+                text = zlib.decompress(row[0])
+                value = json.loads(text.decode('utf-8'))
+                return (value, len(text)) if with_size else value
+        except sqlite3.OperationalError as error:
+            if not expected(error):
+                logging.exception('%s: could not read from %s', self.name, self.path)
+            # Locked by another process, ask Karp instead
+            self.skipped += 1
+            logging.debug('%s: could not read from %s: %s', self.name, self.path, error)
+        except (sqlite3.Error, OSError, ValueError, zlib.error):
+            logging.exception('%s: could not read from %s', self.name, self.path)
+        self.misses += 1
+        return (None, 0) if with_size else None
+
+    def set(self, key, version, value, ttl):
+        """ Store a result (anything json can encode) for `ttl` seconds.
+            The first element of `key` is the mode.
+        """
+        if not self.enabled() or ttl <= 0:
+            return
+        data = zlib.compress(json.dumps(value, separators=(',', ':')).encode('utf-8'), 1)
+        if len(data) > self.maxbytes:
+            return
+        now = time.time()
+        try:
+            self.connect().execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)',
+                                   (self.key(key), key[0], version, now + ttl, now, data))
+        except sqlite3.OperationalError as error:
+            if not expected(error):
+                logging.exception('%s: could not write to %s', self.name, self.path)
+            # Locked by another process, or full until the next compaction
+            self.skipped += 1
+            logging.debug('%s: could not write to %s: %s', self.name, self.path, error)
+        except (sqlite3.Error, OSError):
+            logging.exception('%s: could not write to %s', self.name, self.path)
+
+    def take_used(self):
+        """ The times results were read since the last call, for `save_used` or `compact` """
+        used, self.used = self.used, {}
+        return used
+
+    def save_used(self, used):
+        """ Save when results were last read (key -> time).
+            Blocks, run it in a thread.
+        """
+        if not self.enabled() or not used:
+            return
+        try:
+            db = self.open(COMPACT_TIMEOUT)
+            try:
+                db.executemany('UPDATE results SET used = ? WHERE key = ?',
+                               [(when, key) for key, when in used.items()])
+            finally:
+                db.close()
+        except (sqlite3.Error, OSError):
+            logging.exception('%s: could not write to %s', self.name, self.path)
+
+    def compact(self, versions, used=None):
+        """ Save when results were last read (`used`: key -> time), remove the
+            results that have expired or whose mode is not at the version given
+            in `versions` (mode -> version), and then the least recently used
+            until the file fits in `maxbytes`.
+            Blocks, run it in a thread. Return the number of results removed.
+        """
+        if not self.enabled():
+            return 0
+        try:
+            db = self.open(COMPACT_TIMEOUT)
+        except (sqlite3.Error, OSError):
+            logging.exception('%s: could not compact %s', self.name, self.path)
+            return 0
+        try:
+            if db.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+                # Made before auto_vacuum was set, rebuild it once
+                db.execute('PRAGMA auto_vacuum=INCREMENTAL')
+                db.execute('VACUUM')
+            if used:
+                db.executemany('UPDATE results SET used = ? WHERE key = ?',
+                               [(when, key) for key, when in used.items()])
+            removed = db.execute('DELETE FROM results WHERE expires <= ?', (time.time(),)).rowcount
+            for mode, version in db.execute('SELECT DISTINCT mode, version FROM results').fetchall():
+                if versions.get(mode) != version:
+                    removed += db.execute('DELETE FROM results WHERE mode = ? AND version = ?',
+                                          (mode, version)).rowcount
+            # Each step frees one page, executescript runs all of them
+            db.executescript('PRAGMA incremental_vacuum;')
+            removed += self.shrink(db)
+            db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        except (sqlite3.Error, OSError):
+            logging.exception('%s: could not compact %s', self.name, self.path)
+            return 0
+        finally:
+            db.close()
+        logging.info('%s: removed %s results', self.name, removed)
+        return removed
+
+    def shrink(self, db):
+        """ Remove the least recently used results until the file fits in `maxbytes` """
+        removed = 0
+        while True:
+            size = file_size(db)
+            if size <= self.maxbytes:
+                return removed
+            rows = db.execute('SELECT key, LENGTH(value) FROM results ORDER BY used').fetchall()
+            if not rows:
+                return removed
+            # Remove what the file is too big by, counting the overhead of the pages
+            payload = sum(length for _, length in rows)
+            excess = (size - self.maxbytes) * payload / size
+            oldest = []
+            for key, length in rows:
+                oldest.append((key,))
+                excess -= length
+                if excess <= 0:
+                    break
+            db.executemany('DELETE FROM results WHERE key = ?', oldest)
+            # Each step frees one page, executescript runs all of them
+            db.executescript('PRAGMA incremental_vacuum;')
+            removed += len(oldest)
+            self.evictions += len(oldest)
+
+    def stats(self):
+        """ Hit and miss counters, and disk use """
+        size, used = 0, 0
+        if self.enabled() and self.db is not None:
+            try:
+                size = self.db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+                used = file_size(self.db)
+            except sqlite3.Error as error:
+                logging.warning('%s: could not read from %s: %s', self.name, self.path, error)
+        return {'size': size,
+                'bytes': used,
+                'maxbytes': self.maxbytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'skipped': self.skipped}
+
+
+def expected(error):
+    """ Whether an error only means that the database was busy or full """
+    return str(error) in ('database is locked', 'database table is locked', 'database or disk is full')
+
+
+def file_size(db):
+    """ Bytes used by the database file, not counting free pages """
+    pages = db.execute('PRAGMA page_count').fetchone()[0] - db.execute('PRAGMA freelist_count').fetchone()[0]
+    return pages * db.execute('PRAGMA page_size').fetchone()[0]
@@ -31,3 +31,24 @@ class QueryError(Exception):
     def __init__(self, message):
         super().__init__()
         self.message += message
+
+
+class KarpError(Exception):
+    """ Karp (or another upstream server) could not be reached """
+    message = "Upstream call failed. "
+    code = 502
+
+    def __init__(self, message):
+        super().__init__()
+        self.message += message
+
+
+class BusyError(Exception):
+    """ The server has too much to do, the client should come back later """
+    message = "Server busy. "
+    code = 503
+
+    def __init__(self, message, retry_after):
+        super().__init__()
+        self.message += message
+        self.retry_after = retry_after
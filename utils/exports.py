@@ -0,0 +1,111 @@
+""" Html exports of published subtypes, rendered in advance and kept on disk.
+    A stored export is everything after the html header, which depends on
+    the url of the css and is added when the export is sent.
+    The file name contains a hash of the content, so that all worker
+    processes can tell the versions apart.
+"""
+import hashlib
+import logging
+import os
+import os.path
+import re
+import tempfile
+import urllib.parse
+
+import conf.settings as settings
+
+# Number of hex digits of the content hash used in file names
+DIGEST_LENGTH = 16
+# Bytes read at a time when sending a big export
+CHUNK_SIZE = 1024 * 1024
+FILE_NAME = re.compile(r'(.+)\.([^.]+)\.([0-9a-f]{{{}}})\.html'.format(DIGEST_LENGTH))
+
+
+class StoredExport(object):
+    """ A rendered export on disk """
+
+    def __init__(self, path, digest):
+        self.path = path
+        self.digest = digest
+
+
+def directory(mode):
+    return os.path.join(settings.config(mode).export_dir, mode)
+
+
+def versions(mode, subtype=None, lang=None):
+    """ The stored files of a subtype, or of all subtypes, as (path, subtype, lang, digest) """
+    folder = directory(mode)
+    if not os.path.isdir(folder):
+        return []
+    found = []
+    for entry in os.scandir(folder):
+        match = FILE_NAME.fullmatch(entry.name)
+        if match is None:
+            continue
+        name = urllib.parse.unquote(match.group(1))
+        if subtype in (None, name) and lang in (None, match.group(2)):
+            found.append((entry.path, name, match.group(2), match.group(3)))
+    return found
+
+
+def find(mode, subtype, lang):
+    """ The stored export of a subtype in a language, or None """
+    found = versions(mode, subtype, lang)
+    if not found:
+        return None
+    # There is only one version, unless another process is replacing it
+    path, _, _, digest = max(found, key=lambda version: mtime(version[0]))
+    return StoredExport(path, digest)
+
+
+def mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except FileNotFoundError:
+        return 0
+
+
+def store(mode, subtype, lang, body):
+    """ Save a rendered export, and remove the older versions.
+        Nothing is written if the content has not changed.
+    """
+    digest = hashlib.sha256(body).hexdigest()[:DIGEST_LENGTH]
+    folder = directory(mode)
+    os.makedirs(folder, exist_ok=True)
+    name = '{}.{}.{}.html'.format(urllib.parse.quote(subtype, safe=''), lang, digest)
+    path = os.path.join(folder, name)
+    if not os.path.isfile(path):
+        handle, tmppath = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as tmpfile:
+                tmpfile.write(body)
+            os.replace(tmppath, path)
+        except OSError:
+            os.unlink(tmppath)
+            raise
+        logging.info('Stored export of %s (%s), %s bytes', subtype, lang, len(body))
+    for oldpath, _, _, olddigest in versions(mode, subtype, lang):
+        if olddigest != digest:
+            remove_file(oldpath)
+    return StoredExport(path, digest)
+
+
+def remove(mode, subtype):
+    """ Delete the stored exports of a subtype, in all languages """
+    for path, _, _, _ in versions(mode, subtype):
+        remove_file(path)
+
+
+def remove_unpublished(mode, subtypes):
+    """ Delete the stored exports of all subtypes but these """
+    for path, subtype, _, _ in versions(mode):
+        if subtype not in subtypes:
+            remove_file(path)
+
+
+def remove_file(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
@@ -1,34 +1,32 @@
 """ Request handlers are defined here """
-import json
+import hashlib
 import logging
-import os
-import os.path
 import tornado.web
-import urllib.request
 
 import conf.settings as settings
+import utils.cache as cache
 import utils.errors as errors
+import utils.karp as karp
+import utils.metrics as metrics
+
+# Karp's answers to /checkuser
+auth_cache = cache.LRUCache('auth', int(settings.config().auth_cache_size))
 
 
 class BaseHandler(tornado.web.RequestHandler):
     """ Base Handler. """
 
     def prepare(self):
-        """ Set up file system """
-        try:
-            for mode in settings.get_modes():
-                if mode == 'default':
-                    continue
-                typefile = settings.get('subtypes', mode)
-                directory = os.path.dirname(typefile)
-                # TODO this only works for paths like a/b.txt, not b.txt och a/b/c.txt
-                if not os.path.isdir(directory):
-                    os.mkdir(directory)
-                if not os.path.isfile(typefile):
-                    open(typefile, 'w').write('')
-        except errors.ConfigurationError as error:
-            self.return_error(error)
+        """ Start timing the phases of the request """
+        self.timings = metrics.Timings()
+
+    def on_finish(self):
+        metrics.observe('request_seconds', self.request.request_time(), handler=type(self).__name__)
 
+    def set_timing_header(self):
+        """ Tell the client where the time went """
+        if self.timings.phases:
+            self.set_header('Server-Timing', self.timings.header())
 
     def options(self, *args, **kwargs):
         """ Option call: do nothing """
@@ -45,6 +43,8 @@ class BaseHandler(tornado.web.RequestHandler):
         """ Return an error and finish the call """
         self.set_status(error.code)
         self.set_header('Content-Type', 'text/plain')
+        if isinstance(error, errors.BusyError):
+            self.set_header('Retry-After', error.retry_after)
         self.write({"error": error.message})
         self.finish()
 
@@ -52,33 +52,51 @@ class BaseHandler(tornado.web.RequestHandler):
 class SafeHandler(BaseHandler):
     """ Handlers where authentication can be added """
 
-    def authenticate(self, mode):
-        """ Authenticate to Karp. """
-        try:
-            auth_header = self.request.headers.get('Authorization')
-            basic = auth_header[6:]
-            url = settings.karp + '/checkuser'
-            req = urllib.request.Request(url)
-            req.add_header('Authorization', 'Basic %s' % basic)
-            response = json.loads(urllib.request.urlopen(req).read().decode('utf8'))
-            ok = response["authenticated"]
-        except:
-            ok = False
-        if not ok:
+    async def authenticate(self, mode):
+        """ Authenticate to Karp.
+            Answers are cached for a while, keyed by a hash of the credentials.
+        """
+        config = settings.config(mode)
+        auth_header = self.request.headers.get('Authorization', '')
+        key = ('checkuser', hashlib.sha256(auth_header.encode('utf-8')).hexdigest())
+        resources = auth_cache.get(key)
+        if resources is None:
+            resources = await check_user(auth_header, mode)
+            if resources is not None:
+                failed = resources is False
+                ttl = config.auth_cache_fail_ttl if failed else config.auth_cache_ttl
+                auth_cache.set(key, resources, ttl)
+        if resources is None or resources is False:
             logging.debug('Bad username or password?')
             error = errors.AuthenticationError("Bad username or password?")
             self.return_error(error)
             raise error
         else:
-            resources = response.get("permitted_resources", {}).get("lexica", {})
-            lexok = settings.get('resource', mode) in resources
+            lexok = config.resource in resources
             if not lexok:
                 logging.debug('Cannot edit resource %s', resources)
                 error = errors.AuthenticationError("You are not allowed to edit the resource")
                 self.return_error(error)
+                raise error
 
 
     def options(self, *args, **kwargs):
         """ Options call: do nothing """
         self.set_status(204)
         self.finish()
+
+
+async def check_user(auth_header, mode):
+    """ Ask Karp which lexica the user may edit.
+        Return False if the user is not authenticated, and None if Karp
+        could not tell.
+    """
+    if not auth_header.startswith('Basic '):
+        return False
+    try:
+        response = await karp.call('checkuser', {}, mode, auth=auth_header)
+    except errors.KarpError:
+        return None
+    if not response.get("authenticated"):
+        return False
+    return frozenset(response.get("permitted_resources", {}).get("lexica", {}))
@@ -0,0 +1,46 @@
+""" Statistics about how many entries a browse (empty query) matches """
+import collections
+
+
+class HitCounts(object):
+    """ The number of hits per mode, language and set of subtypes.
+        Bounded in size, the least recently used counts are forgotten first.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.counts = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(mode, lang, subtypes):
+        return (mode, lang, frozenset(subtypes))
+
+    def get(self, mode, lang, subtypes):
+        """ The number of hits, or None if not known """
+        key = self.key(mode, lang, subtypes)
+        total = self.counts.get(key)
+        if total is None:
+            self.misses += 1
+            return None
+        self.counts.move_to_end(key)
+        self.hits += 1
+        return total
+
+    def set(self, mode, lang, subtypes, total):
+        key = self.key(mode, lang, subtypes)
+        self.counts[key] = total
+        self.counts.move_to_end(key)
+        while len(self.counts) > self.maxsize:
+            self.counts.popitem(last=False)
+
+    def keys(self):
+        """ All (mode, lang, subtypes) that have a count """
+        return list(self.counts.keys())
+
+    def stats(self):
+        return {'size': len(self.counts),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses}
@@ -0,0 +1,74 @@
+""" Asynchronous client for all calls to Karp (and other upstream servers) """
+import base64
+import json
+import logging
+import time
+import urllib.parse
+
+from tornado.httpclient import AsyncHTTPClient, HTTPError, HTTPRequest
+
+import conf.settings as settings
+import utils.errors as errors
+import utils.metrics as metrics
+
+try:
+    import pycurl  # noqa: F401
+    # The curl client keeps connections to Karp alive between calls
+    CLIENT = "tornado.curl_httpclient.CurlAsyncHTTPClient"
+except ImportError:
+    CLIENT = None
+
+
+def configure():
+    """ Set up the http client used for all upstream calls """
+    max_clients = int(settings.config().karp_max_clients)
+    AsyncHTTPClient.configure(CLIENT, max_clients=max_clients)
+    logging.debug('Karp client %s, max %s concurrent calls', CLIENT or 'simple', max_clients)
+
+
+async def fetch(url, mode, headers=None, timeout=None, raise_error=True):
+    """ Fetch an url, without blocking the IOLoop. Return the raw response. """
+    config = settings.config(mode)
+    if timeout is None:
+        timeout = config.karp_timeout
+    request = HTTPRequest(url,
+                          headers=headers,
+                          connect_timeout=config.karp_connect_timeout,
+                          request_timeout=timeout)
+    try:
+        return await AsyncHTTPClient().fetch(request, raise_error=raise_error)
+    except (HTTPError, OSError) as error:
+        logging.warning('Call to %s failed: %s', url, error)
+        metrics.inc('upstream_errors_total', host=urllib.parse.urlsplit(url).hostname)
+        raise errors.KarpError(str(error))
+
+
+async def call(path, params, mode, auth=None, timeout=None, with_size=False):
+    """ Call Karp and return the decoded answer, and its length in bytes
+        if `with_size` is set.
+        Use the credentials of the mode, unless `auth` is given.
+    """
+    full_url = '{}/{}?{}'.format(settings.karp, path, urllib.parse.urlencode(params))
+    logging.debug(full_url)
+    headers = {'Authorization': auth or credentials(mode)}
+    start = time.perf_counter()
+    response = await fetch(full_url, mode, headers=headers, timeout=timeout)
+    metrics.observe('karp_call_seconds', time.perf_counter() - start, call=path)
+    try:
+        answer = json.loads(response.body.decode())
+    except ValueError:
+        # An error page from Karp or a proxy in between
+        logging.warning('Call to %s did not return json: %r', full_url, response.body[:200])
+        metrics.inc('upstream_errors_total', host=urllib.parse.urlsplit(full_url).hostname)
+        raise errors.KarpError('Bad answer from Karp')
+    if with_size:
+        return answer, len(response.body)
+    return answer
+
+
+def credentials(mode):
+    """ Basic authorization header value for the mode's Karp user """
+    config = settings.config(mode)
+    credentials = ('%s:%s' % (config.username, config.password))
+    encoded_credentials = base64.b64encode(credentials.encode('ascii'))
+    return 'Basic %s' % encoded_credentials.decode("ascii")
@@ -0,0 +1,132 @@
+""" Timing and counters, exported in Prometheus' text format """
+import contextlib
+import time
+
+# Upper bounds (in seconds) of the histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram(object):
+    """ Counts observations per bucket """
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for ix, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[ix] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+
+# name -> labels -> Histogram
+histograms = {}
+# name -> labels -> number
+counters = {}
+# Help texts, by metric name
+descriptions = {}
+
+
+def describe(name, text):
+    descriptions[name] = text
+
+
+def observe(name, seconds, **labels):
+    """ Add a duration to a histogram """
+    key = tuple(sorted(labels.items()))
+    histogram = histograms.setdefault(name, {}).get(key)
+    if histogram is None:
+        histogram = histograms[name][key] = Histogram()
+    histogram.observe(seconds)
+
+
+def inc(name, amount=1, **labels):
+    """ Increase a counter """
+    key = tuple(sorted(labels.items()))
+    counter = counters.setdefault(name, {})
+    counter[key] = counter.get(key, 0) + amount
+
+
+class Timings(object):
+    """ The time spent in each phase of one request.
+        Every phase is also added to the `phase_seconds` histogram.
+    """
+
+    def __init__(self):
+        self.phases = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+        observe('phase_seconds', seconds, phase=name)
+
+    def header(self):
+        """ The value of a Server-Timing header """
+        return ', '.join('{};dur={:.2f}'.format(name, seconds * 1000)
+                         for name, seconds in self.phases.items())
+
+
+@contextlib.contextmanager
+def timed(timings, name):
+    """ Time a phase if there are timings to add it to """
+    if timings is None:
+        yield
+    else:
+        with timings.phase(name):
+            yield
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('"', '\\"'))
+                          for key, value in labels) + '}'
+
+
+def render(extra=()):
+    """ All metrics in Prometheus' text format.
+        `extra` are values kept elsewhere, as (name, type, labels, value).
+    """
+    lines = []
+    for name, by_labels in sorted(histograms.items()):
+        if name in descriptions:
+            lines.append('# HELP {} {}'.format(name, descriptions[name]))
+        lines.append('# TYPE {} histogram'.format(name))
+        for labels, histogram in sorted(by_labels.items()):
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', bound),)), cumulative))
+            lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', '+Inf'),)), histogram.count))
+            lines.append('{}_sum{} {}'.format(name, format_labels(labels), histogram.sum))
+            lines.append('{}_count{} {}'.format(name, format_labels(labels), histogram.count))
+    for name, by_labels in sorted(counters.items()):
+        if name in descriptions:
+            lines.append('# HELP {} {}'.format(name, descriptions[name]))
+        lines.append('# TYPE {} counter'.format(name))
+        for labels, value in sorted(by_labels.items()):
+            lines.append('{}{} {}'.format(name, format_labels(labels), value))
+    typed = set()
+    for name, kind, labels, value in sorted(extra, key=lambda metric: metric[0]):
+        if name not in typed:
+            lines.append('# TYPE {} {}'.format(name, kind))
+            typed.add(name)
+        lines.append('{}{} {}'.format(name, format_labels(tuple(sorted(labels.items()))), value))
+    return '\n'.join(lines) + '\n'
+
+
+describe('phase_seconds', 'Time spent in each phase of a request')
+describe('karp_call_seconds', 'Duration of calls to Karp')
+describe('request_seconds', 'Duration of requests, per handler')
+describe('upstream_errors_total', 'Failed calls to Karp and other upstream servers')
@@ -0,0 +1,132 @@
+""" A local copy of the published entries of a mode, used for answering
+    searches without asking Karp
+"""
+import bisect
+import heapq
+import logging
+import zlib
+
+import utils.ngram as ngram
+
+# The mirror of every mode that has one
+mirrors = {}
+
+
+class Mirror(object):
+    """ The published entries of one mode, indexed by lowercased source and
+        target forms (in sorted order) and by subtype.
+        Entries are kept in the order of the source language (`sourcesort`), and `target_rank` gives
+        their position when sorted by the target language.
+        If `ngram_budget` (bytes) allows, the forms are also indexed for
+        substring search.
+    """
+
+    def __init__(self, mode, hits, target_order, ngram_budget=0):
+        self.mode = mode
+        self.entries = [hit['_source'] for hit in hits]
+        # The same entries in the same order give the same version in every process
+        ids = [hit['_id'] for hit in hits] + [''] + list(target_order)
+        self.version = zlib.crc32('\n'.join(ids).encode())
+        positions = {hit['_id']: pos for pos, hit in enumerate(hits)}
+        self.target_rank = [len(hits)] * len(hits)
+        for rank, _id in enumerate(target_order):
+            if _id in positions:
+                self.target_rank[positions[_id]] = rank
+
+        self.by_subtype = {}
+        source, target = [], []
+        for pos, entry in enumerate(self.entries):
+            for subtype in entry.get('subtype', []):
+                self.by_subtype.setdefault(subtype, []).append(pos)
+            for form in source_forms(entry):
+                source.append((form, pos))
+            for form in target_forms(entry):
+                target.append((form, pos))
+        self.forms = {}
+        self.positions = {}
+        for side, index in [('source', source), ('target', target)]:
+            index.sort()
+            self.forms[side] = [form for form, _ in index]
+            self.positions[side] = [pos for _, pos in index]
+        logging.info('Mirror of %s: %s entries, %s forms', mode, len(self.entries),
+                     len(source) + len(target))
+
+        self.ngrams = None
+        if ngram_budget > 0:
+            source_ngrams = ngram.build(self.forms['source'], ngram_budget)
+            if source_ngrams is not None:
+                target_ngrams = ngram.build(self.forms['target'], ngram_budget - source_ngrams.size)
+                if target_ngrams is not None:
+                    self.ngrams = {'source': source_ngrams, 'target': target_ngrams}
+
+    def prefix(self, word, side):
+        """ Positions of all entries having a form starting with `word` """
+        forms = self.forms[side]
+        start = bisect.bisect_left(forms, word)
+        end = bisect.bisect_left(forms, word + '\uffff', lo=start)
+        return set(self.positions[side][start:end])
+
+    def contains(self, word, side):
+        """ Positions of all entries having a form containing `word` """
+        positions = self.positions[side]
+        return {positions[ix] for ix in self.ngrams[side].search(word)}
+
+    def search(self, word, subtypes, source, size, contains=False):
+        """ Find the entries in any of the subtypes having a form starting with
+            (or containing, if `contains`) `word` (all entries, if empty).
+            Sort them by the source language if `source`, otherwise by the
+            target language.
+            Return the total number of hits and the first `size` entries.
+        """
+        hits = self.matches(word, subtypes, source, contains)
+        key = None if source else self.target_rank.__getitem__
+        first = heapq.nsmallest(size, hits, key=key)
+        return len(hits), [self.entries[pos] for pos in first]
+
+    def page(self, word, subtypes, source, size, contains=False, after=None, start=0):
+        """ Like `search`, but return the `size` entries that come after the
+            sort key `after`, or after the first `start` entries.
+            Also return the sort key of the last entry, or None if there are
+            no more hits.
+        """
+        hits = self.matches(word, subtypes, source, contains)
+        if source:
+            key = lambda pos: (pos,)
+        else:
+            key = lambda pos: (self.target_rank[pos], pos)
+        if after is not None:
+            after = tuple(after)
+            hits_after = [pos for pos in hits if key(pos) > after]
+        else:
+            hits_after = hits
+        first = heapq.nsmallest(start + size, hits_after, key=key)[start:]
+        last = None
+        if first and len(hits_after) > start + size:
+            last = list(key(first[-1]))
+        return len(hits), [self.entries[pos] for pos in first], last
+
+    def matches(self, word, subtypes, source, contains):
+        """ Positions of the entries of a search, in no particular order """
+        if word:
+            wanted = set(subtypes)
+            side = 'source' if source else 'target'
+            find = self.contains if contains else self.prefix
+            return [pos for pos in find(word.lower(), side)
+                    if wanted.intersection(self.entries[pos].get('subtype', []))]
+        hits = set()
+        for subtype in subtypes:
+            hits.update(self.by_subtype.get(subtype, []))
+        return hits
+
+
+def source_forms(entry):
+    " The lowercased source language forms of an entry "
+    return {form.get('wordform', '').strip().lower()
+            for form in entry.get('baselang', {}).get('form', [])}
+
+
+def target_forms(entry):
+    " The lowercased target language forms of an entry "
+    return {form.get('wordform', '').strip().lower()
+            for target in entry.get('targetlang', [])
+            for form in target.get('form', [])}
@@ -0,0 +1,67 @@
+""" Trigram index for substring ("contains") search """
+import array
+import logging
+
+N = 3
+# Rough memory use of a trigram key and its dict slot, in bytes
+KEY_OVERHEAD = 120
+# Bytes per posting
+POSTING_SIZE = array.array('I').itemsize
+
+
+class NgramIndex(object):
+    """ Maps every trigram to the (sorted) ids of the forms containing it.
+        Substring search intersects the posting lists of the trigrams of the
+        query, and then checks the remaining candidates.
+    """
+
+    def __init__(self, forms, postings, size):
+        self.forms = forms
+        self.postings = postings
+        self.size = size
+
+    def search(self, word):
+        """ The ids of all forms containing `word` """
+        grams = ngrams(word)
+        if not grams:
+            # Too short for the index, check every form
+            return [ix for ix, form in enumerate(self.forms) if word in form]
+        postings = []
+        for gram in grams:
+            posting = self.postings.get(gram)
+            if posting is None:
+                return []
+            postings.append(posting)
+        postings.sort(key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            candidates.intersection_update(posting)
+            if not candidates:
+                return []
+        return [ix for ix in candidates if word in self.forms[ix]]
+
+
+def ngrams(word):
+    " All distinct trigrams of a word "
+    return {word[i:i+N] for i in range(len(word) - N + 1)}
+
+
+def build(forms, budget):
+    """ Index the forms. Give up, and return None, if the index would use
+        more than `budget` bytes.
+    """
+    postings = {}
+    size = 0
+    for ix, form in enumerate(forms):
+        for gram in ngrams(form):
+            posting = postings.get(gram)
+            if posting is None:
+                posting = postings[gram] = array.array('I')
+                size += KEY_OVERHEAD
+            posting.append(ix)
+            size += POSTING_SIZE
+        if size > budget:
+            logging.warning('Trigram index would use more than %s bytes, not built', budget)
+            return None
+    logging.info('Trigram index of %s forms: %s trigrams, %s bytes', len(forms), len(postings), size)
+    return NgramIndex(forms, postings, size)
@@ -0,0 +1,156 @@
+""" A minimal pdf writer: paragraphs of text, wrapped and paged.
+    Only the standard Helvetica fonts are used, so nothing needs to be
+    embedded, and text is written in the WinAnsi encoding (cp1252), which
+    covers Swedish and Finnish. Other characters are printed as '?'.
+"""
+import unicodedata
+import zlib
+
+# A4, in points
+PAGE_WIDTH = 595
+PAGE_HEIGHT = 842
+
+FONTS = {'regular': ('F1', 'Helvetica'),
+         'bold': ('F2', 'Helvetica-Bold'),
+         'italic': ('F3', 'Helvetica-Oblique')}
+
+# Character widths of the fonts (in 1/1000 of the font size), for the
+# printable ascii characters. Accented letters are as wide as their base letter.
+HELVETICA = [
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+    1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+    333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+    556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584]
+HELVETICA_BOLD = [
+    278, 333, 474, 556, 556, 889, 722, 238, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 333, 333, 584, 584, 584, 611,
+    975, 722, 722, 722, 722, 667, 611, 778, 722, 278, 556, 722, 611, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 333, 278, 333, 584, 556,
+    333, 556, 611, 556, 611, 556, 333, 611, 611, 278, 278, 556, 278, 889, 611, 611,
+    611, 611, 389, 556, 333, 611, 556, 778, 556, 556, 500, 389, 280, 389, 584]
+WIDTHS = {'regular': HELVETICA, 'bold': HELVETICA_BOLD, 'italic': HELVETICA}
+# Width of characters not in the tables
+DEFAULT_WIDTH = 556
+
+
+def char_width(char, style):
+    code = ord(char)
+    if code < 32 or code > 126:
+        code = ord(unicodedata.normalize('NFD', char)[0])
+    if 32 <= code <= 126:
+        return WIDTHS[style][code - 32]
+    return DEFAULT_WIDTH
+
+
+def text_width(text, style, fontsize):
+    return sum(char_width(char, style) for char in text) * fontsize / 1000
+
+
+def pdf_string(text):
+    " A pdf string literal "
+    data = text.encode('cp1252', errors='replace')
+    data = data.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)')
+    return b'(' + data + b')'
+
+
+class Document(object):
+    """ A pdf document. Add paragraphs, then render it. """
+
+    def __init__(self, title='', fontsize=10, margin=56):
+        self.title = title
+        self.fontsize = fontsize
+        self.leading = fontsize * 1.3
+        self.margin = margin
+        self.pages = []
+        self.lines = None
+        self.y = 0
+
+    def paragraph(self, runs, indent=0, space_before=0):
+        """ Add a paragraph, wrapped to the width of the page.
+            `runs` are (style, text), where style is 'regular', 'bold' or 'italic'.
+        """
+        width = PAGE_WIDTH - 2 * self.margin - indent
+        space = text_width(' ', 'regular', self.fontsize)
+        line, used = [], 0
+        self.y -= space_before
+        for style, text in runs:
+            words = text.split(' ')
+            for ix, word in enumerate(words):
+                # A run continues the last word of the one before, unless separated by a space
+                if ix > 0 and line:
+                    line.append(('regular', ' '))
+                    used += space
+                wordwidth = text_width(word, style, self.fontsize)
+                if used + wordwidth > width and used > 0:
+                    self.write_line(line, indent)
+                    line, used = [], 0
+                    if not word:
+                        continue
+                line.append((style, word))
+                used += wordwidth
+        if line:
+            self.write_line(line, indent)
+
+    def write_line(self, line, indent):
+        " Put a line of (style, text) on the page, on a new page if needed "
+        while line and line[-1][1].strip() == '':
+            line.pop()
+        if self.lines is None or self.y - self.leading < self.margin:
+            self.lines = []
+            self.pages.append(self.lines)
+            self.y = PAGE_HEIGHT - self.margin
+        self.y -= self.leading
+        ops = [b'BT', '{:.2f} {:.2f} Td'.format(self.margin + indent, self.y).encode()]
+        # Consecutive words in the same font are written at once, spaces fit in any font
+        groups = []
+        for style, text in line:
+            if groups and (groups[-1][0] == style or text == ' '):
+                groups[-1][1] += text
+            else:
+                groups.append([style, text])
+        for style, text in groups:
+            ops.append('/{} {} Tf '.format(FONTS[style][0], self.fontsize).encode() + pdf_string(text) + b' Tj')
+        ops.append(b'ET')
+        self.lines.append(b'\n'.join(ops))
+
+    def render(self):
+        """ The pdf file, as bytes """
+        pages = self.pages or [[]]
+        objects = []
+
+        def add(body):
+            objects.append(body)
+            return len(objects)
+
+        catalog = add(None)
+        page_tree = add(None)
+        fonts = b' '.join('/{} {} 0 R'.format(name, add(
+            '<< /Type /Font /Subtype /Type1 /BaseFont /{} /Encoding /WinAnsiEncoding >>'.format(font).encode()
+        )).encode() for name, font in FONTS.values())
+        kids = []
+        for lines in pages:
+            content = zlib.compress(b'\n'.join(lines))
+            stream = add(b'<< /Length ' + str(len(content)).encode() + b' /Filter /FlateDecode >>\nstream\n'
+                         + content + b'\nendstream')
+            kids.append(add('<< /Type /Page /Parent {} 0 R /Contents {} 0 R >>'.format(page_tree, stream).encode()))
+        objects[catalog - 1] = '<< /Type /Catalog /Pages {} 0 R >>'.format(page_tree).encode()
+        objects[page_tree - 1] = ('<< /Type /Pages /Kids [{}] /Count {} /MediaBox [0 0 {} {}] '.format(
+            ' '.join('{} 0 R'.format(kid) for kid in kids), len(kids), PAGE_WIDTH, PAGE_HEIGHT).encode()
+            + b'/Resources << /Font << ' + fonts + b' >> >> >>')
+        info = add(b'<< /Title ' + pdf_string(self.title) + b' /Producer (minoritetsordlistor) >>')
+
+        output = [b'%PDF-1.4\n%\xe5\xe4\xf6\xc5\n']
+        offsets = []
+        length = len(output[0])
+        for number, body in enumerate(objects, 1):
+            offsets.append(length)
+            part = '{} 0 obj\n'.format(number).encode() + body + b'\nendobj\n'
+            output.append(part)
+            length += len(part)
+        xref = ['xref', '0 {}'.format(len(objects) + 1), '0000000000 65535 f ']
+        xref.extend('{:010d} 00000 n '.format(offset) for offset in offsets)
+        output.append(('\n'.join(xref) + '\ntrailer\n<< /Size {} /Root {} 0 R /Info {} 0 R >>\n'
+                       'startxref\n{}\n%%EOF\n').format(len(objects) + 1, catalog, info, length).encode())
+        return b''.join(output)
@@ -0,0 +1,46 @@
+""" Selection of the fields of entries that are sent to the client """
+import re
+
+import utils.errors as errors
+
+FIELD = re.compile(r'[\w-]+(\.[\w-]+)*')
+
+
+def parse(text):
+    """ The fields of a `fields` argument ("baselang.form,subtype"), in order """
+    fields = [field.strip() for field in text.split(',') if field.strip()]
+    for field in fields:
+        if not FIELD.fullmatch(field):
+            raise errors.QueryError('Bad field: {}'.format(field))
+    return fields
+
+
+def tree(fields):
+    """ The fields as a nested dict, where None means the whole value
+        ['baselang.form', 'subtype'] -> {'baselang': {'form': None}, 'subtype': None}
+    """
+    root = {}
+    for field in fields:
+        node = root
+        *path, last = field.split('.')
+        for key in path:
+            child = node.get(key, {})
+            if child is None:
+                # The whole parent is already selected
+                break
+            node[key] = child
+            node = child
+        else:
+            node[last] = None
+    return root
+
+
+def project(value, fields):
+    """ Keep the selected fields (a tree) of a value. Lists are projected item by item. """
+    if fields is None:
+        return value
+    if isinstance(value, list):
+        return [project(item, fields) for item in value]
+    if isinstance(value, dict):
+        return {key: project(value[key], sub) for key, sub in fields.items() if key in value}
+    return value
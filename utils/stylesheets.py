@@ -0,0 +1,78 @@
+""" Cached copies of the css files of every mode """
+import email.utils
+import hashlib
+import logging
+import time
+
+import tornado.ioloop
+
+import conf.settings as settings
+import utils.errors as errors
+import utils.karp as karp
+
+
+class Stylesheet(object):
+    """ One version of a css file """
+
+    def __init__(self, body, headers):
+        self.body = body
+        self.etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        self.upstream_etag = headers.get('Etag')
+        self.last_modified = headers.get('Last-Modified') or email.utils.formatdate(usegmt=True)
+        self.fetched = time.monotonic()
+
+    def modified_since(self, since):
+        """ Whether this version is newer than the http date `since` """
+        try:
+            return (email.utils.parsedate_to_datetime(self.last_modified) >
+                    email.utils.parsedate_to_datetime(since))
+        except (TypeError, ValueError):
+            return True
+
+
+stylesheets = {}
+refreshing = set()
+
+
+async def get(mode):
+    """ Return the css of a mode. Fetch it if it has never been fetched,
+        and revalidate it in the background when it is older than `css_ttl`.
+    """
+    stylesheet = stylesheets.get(mode)
+    if stylesheet is None:
+        return await refresh(mode)
+    if time.monotonic() - stylesheet.fetched > settings.config(mode).css_ttl and mode not in refreshing:
+        tornado.ioloop.IOLoop.current().spawn_callback(refresh_quietly, mode)
+    return stylesheet
+
+
+async def refresh(mode):
+    """ Fetch the css of a mode, unless it has not changed """
+    url = settings.config(mode).css
+    stylesheet = stylesheets.get(mode)
+    headers = {}
+    if stylesheet is not None:
+        if stylesheet.upstream_etag:
+            headers['If-None-Match'] = stylesheet.upstream_etag
+        headers['If-Modified-Since'] = stylesheet.last_modified
+    refreshing.add(mode)
+    try:
+        response = await karp.fetch(url, mode, headers=headers, raise_error=False)
+    finally:
+        refreshing.discard(mode)
+    if response.code == 304 and stylesheet is not None:
+        stylesheet.fetched = time.monotonic()
+    elif response.code == 200:
+        stylesheet = Stylesheet(response.body, response.headers)
+        stylesheets[mode] = stylesheet
+    else:
+        raise errors.KarpError('{} answered {}'.format(url, response.code))
+    return stylesheet
+
+
+async def refresh_quietly(mode):
+    """ Revalidate in the background. On errors, the old copy is kept. """
+    try:
+        await refresh(mode)
+    except errors.KarpError as error:
+        logging.warning('Keeping old css for %s: %s', mode, error.message)
@@ -0,0 +1,176 @@
+""" Keep track of the published subtypes of every mode """
+import contextlib
+import fcntl
+import hashlib
+import logging
+import os
+import os.path
+import tempfile
+import time
+
+import conf.settings as settings
+import utils.errors as errors
+
+
+class SubtypeRegistry(object):
+    """ The published subtypes, read from file once and then served from memory.
+        The files are checked for external edits (for example by other
+        worker processes) at most every `check_interval` seconds, by default
+        `subtypes_check_interval`. The inode, modification time and size of
+        the file identify the version, so any process can see if it has
+        been replaced.
+    """
+
+    def __init__(self):
+        self.subtypes = {}
+        self.stamps = {}
+        self.versions = {}
+        self.digests = {}
+        self.checked = {}
+        self.listeners = []
+        self.check_interval = None
+
+    def on_change(self, callback):
+        """ Call `callback(mode)` whenever the subtypes of a mode change """
+        self.listeners.append(callback)
+
+    def load_all(self):
+        """ Read the subtype files of all modes """
+        for mode in settings.get_modes():
+            try:
+                self.load(mode)
+            except errors.ConfigurationError as error:
+                logging.error(error.message)
+
+    def load(self, mode):
+        """ Read the subtypes of a mode, create the file if needed """
+        typefile = settings.config(mode).get('subtypes')
+        directory = os.path.dirname(typefile)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        if not os.path.isfile(typefile):
+            open(typefile, 'w').write('')
+        self._read(mode, typefile)
+
+    def get(self, mode):
+        """ All published subtypes of the mode, in file order """
+        if mode not in self.subtypes:
+            self.load(mode)
+        else:
+            self._check(mode)
+        return self.subtypes[mode]
+
+    def version(self, mode):
+        """ A counter, increased every time the subtypes of the mode change """
+        self.get(mode)
+        return self.versions[mode]
+
+    def digest(self, mode):
+        """ A hash of the subtypes of the mode, the same in all processes and after restarts """
+        self.get(mode)
+        return self.digests[mode]
+
+    def add(self, subtype, mode):
+        """ Publish a subtype. Return False if it already was published. """
+        with self.locked(mode):
+            subtypes = self.subtypes[mode]
+            if subtype in subtypes:
+                return False
+            self._write(subtypes + [subtype], mode)
+        return True
+
+    def remove(self, subtype, mode):
+        """ Unpublish a subtype. Return False if it was not published. """
+        with self.locked(mode):
+            subtypes = self.subtypes[mode]
+            if subtype not in subtypes:
+                return False
+            self._write([s for s in subtypes if s != subtype], mode)
+        return True
+
+    def update(self, subtypes, mode):
+        """ Replace all subtypes of the mode """
+        with self.locked(mode):
+            self._write(subtypes, mode)
+
+    @contextlib.contextmanager
+    def locked(self, mode):
+        """ Hold a lock on the subtype file, shared with the other worker
+            processes, and read the file again if someone else has changed it.
+            Changes made while holding the lock are based on the latest version.
+        """
+        if mode not in self.subtypes:
+            self.load(mode)
+        typefile = settings.config(mode).get('subtypes')
+        with open(typefile + '.lock', 'a') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                if stamp(typefile) != self.stamps.get(mode):
+                    self._read(mode, typefile)
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def _write(self, subtypes, mode):
+        """ Write the subtypes to file. A temporary file is renamed over the
+            old one, so that a crash never leaves a truncated list.
+        """
+        typefile = settings.config(mode).get('subtypes')
+        directory = os.path.dirname(os.path.abspath(typefile))
+        fd, tmpname = tempfile.mkstemp(dir=directory, prefix='.subtypes')
+        try:
+            # mkstemp makes the file private, keep the permissions of the old one
+            try:
+                mode_bits = os.stat(typefile).st_mode & 0o7777
+            except FileNotFoundError:
+                mode_bits = 0o644
+            os.fchmod(fd, mode_bits)
+            with os.fdopen(fd, 'w', encoding='utf-8') as tmpfile:
+                tmpfile.write('\n'.join(subtypes))
+                tmpfile.flush()
+                # On disk before the rename, so that a crash leaves the old or the new list
+                os.fsync(tmpfile.fileno())
+            os.replace(tmpname, typefile)
+        except OSError:
+            os.unlink(tmpname)
+            raise
+        self._read(mode, typefile)
+
+    def _check(self, mode):
+        """ Reread the file if it has been changed by someone else """
+        interval = self.check_interval
+        if interval is None:
+            interval = settings.config(mode).subtypes_check_interval
+        now = time.monotonic()
+        if now - self.checked.get(mode, 0) < interval:
+            return
+        self.checked[mode] = now
+        typefile = settings.config(mode).get('subtypes')
+        try:
+            if stamp(typefile) != self.stamps.get(mode):
+                logging.info('Subtype file %s has changed', typefile)
+                self._read(mode, typefile)
+        except OSError:
+            logging.exception('Cannot check subtype file %s', typefile)
+
+    def _read(self, mode, typefile):
+        self.stamps[mode] = stamp(typefile)
+        with open(typefile, encoding='utf-8') as typesfile:
+            lines = [s.strip() for s in typesfile.readlines()]
+        self.checked[mode] = time.monotonic()
+        changed = mode in self.subtypes
+        self.subtypes[mode] = [s for s in lines if s]
+        self.versions[mode] = self.versions.get(mode, 0) + 1
+        self.digests[mode] = hashlib.sha1('\n'.join(sorted(self.subtypes[mode])).encode('utf-8')).hexdigest()[:16]
+        if changed:
+            for callback in self.listeners:
+                callback(mode)
+
+
+def stamp(path):
+    """ Identify a version of a file. The inode changes on every atomic update. """
+    stat = os.stat(path)
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+registry = SubtypeRegistry()
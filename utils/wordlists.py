@@ -1,14 +1,67 @@
 """ Module for creating queries to Karp and keeping track of published subtypes """
-import base64
+import asyncio
+import collections
+import hashlib
+import itertools
 import json
 import logging
-import urllib.request
-import urllib.parse
+import os
+
+import tornado.escape
+import tornado.ioloop
+import tornado.process
 
 import conf.settings as settings
+import utils.cache as cache
+import utils.catalogue as catalogue
+import utils.compression as compression
 import utils.errors as errors
+import utils.exports as exports
 import utils.handlers as handlers
+import utils.hitcounts as hitcounts
 import utils.convert as convert
+import utils.cursor as cursor
+import utils.diskcache as diskcache
+import utils.karp as karp
+import utils.metrics as metrics
+import utils.mirror as mirror
+import utils.projection as projection
+import utils.stylesheets as stylesheets
+import utils.subtypes as published
+import utils.workers as workers
+
+# Karp search results, keyed by mode and the full parameter set
+search_cache = cache.LRUCache('search', int(settings.config().cache_size),
+                              int(settings.config().cache_mb) * 1024 * 1024)
+published.registry.on_change(search_cache.invalidate)
+# Karp search results on disk, kept between restarts
+disk_cache = diskcache.DiskCache('disk', settings.config().disk_cache_file,
+                                 int(settings.config().disk_cache_mb) * 1024 * 1024)
+# Complete html exports, and their compressed versions, keyed by mode and query
+export_cache = cache.LRUCache('export', int(settings.config().export_cache_size),
+                              int(settings.config().export_cache_mb) * 1024 * 1024)
+published.registry.on_change(export_cache.invalidate)
+# The html of single entries, checked against a digest of the entry
+fragment_cache = cache.FragmentCache('fragment', int(settings.config().fragment_cache_mb) * 1024 * 1024)
+# Karp calls in progress
+karp_calls = cache.SingleFlight('karp')
+# Number of hits when browsing a set of subtypes
+hit_counts = hitcounts.HitCounts(int(settings.config().hitcount_size))
+# All subtypes in Karp, with their number of entries
+subtype_catalogue = catalogue.Catalogue()
+# Modes whose mirror is currently being downloaded
+refreshing_mirrors = set()
+# Disk caches being compacted
+compacting = set()
+# Exports being rendered, as (mode, subtype, lang)
+rendering_exports = set()
+# Processes (or threads) converting entries to html
+convert_pool = workers.WorkerPool('convert', int(settings.config().convert_workers),
+                                  int(settings.config().convert_queue), settings.config().convert_retry_after,
+                                  kind=settings.config().convert_pool)
+# Processes rendering pdf documents
+pdf_pool = workers.WorkerPool('pdf', int(settings.config().pdf_workers), int(settings.config().pdf_queue),
+                              settings.config().pdf_retry_after)
 
 
 class Info(handlers.BaseHandler):
@@ -24,25 +77,36 @@ class Info(handlers.BaseHandler):
 
 class CSSHandler(handlers.BaseHandler):
     """ Proxy for css files """
-    def get(self, *args):
-        mode = self.get_query_argument('mode', settings.get('mode'))
-        full_url = settings.get('css', mode)
-        req = urllib.request.Request(full_url)
+    async def get(self, *args):
+        mode = self.get_query_argument('mode', settings.config().mode)
+        try:
+            stylesheet = await stylesheets.get(mode)
+        except errors.KarpError as error:
+            self.return_error(error)
+            return
         self.set_header('Content-Type', 'text/css')
-        self.write(urllib.request.urlopen(req).read())
+        self.set_header('Cache-Control', 'public, max-age={}'.format(settings.config(mode).css_max_age))
+        self.set_header('Etag', stylesheet.etag)
+        self.set_header('Last-Modified', stylesheet.last_modified)
+        since = self.request.headers.get('If-Modified-Since')
+        if self.check_etag_header() or (since and not self.request.headers.get('If-None-Match')
+                                        and not stylesheet.modified_since(since)):
+            self.set_status(304)
+            return
+        self.write(stylesheet.body)
 
 
 class PublishHandler(handlers.SafeHandler):
     """ Publish a subtype """
 
-    def get(self, *args):
-        mode = self.get_query_argument('mode', settings.get('mode'))
-        self.authenticate(mode)
+    async def get(self, *args):
+        mode = self.get_query_argument('mode', settings.config().mode)
+        await self.authenticate(mode)
         subtype = args[0]
-        existing = set(get_subtypes(mode))
-        if subtype not in existing:
-            existing.add(subtype)
-            update_subtypes(existing, mode)
+        if published.registry.add(subtype, mode):
+            tornado.ioloop.IOLoop.current().spawn_callback(precompute_hit_counts, subtype, mode)
+            if settings.config(mode).prerender_exports:
+                tornado.ioloop.IOLoop.current().spawn_callback(prerender_exports, subtype, mode)
         subtypes = get_subtypes(mode)
         self.write({'subtype': subtype, 'publish': True, 'subtypes': subtypes})
 
@@ -50,31 +114,89 @@ class PublishHandler(handlers.SafeHandler):
 class UnpublishHandler(handlers.SafeHandler):
     """ Unpublish a subtype """
 
-    def get(self, *args):
-        mode = self.get_query_argument('mode', settings.get('mode'))
-        self.authenticate(mode)
+    async def get(self, *args):
+        mode = self.get_query_argument('mode', settings.config().mode)
+        await self.authenticate(mode)
         subtype = args[0]
-        existing = set(get_subtypes(mode))
-        if subtype in existing:
-            existing.remove(subtype)
-            update_subtypes(existing, mode)
+        published.registry.remove(subtype, mode)
+        exports.remove(mode, subtype)
         subtypes = get_subtypes(mode)
         self.write({'subtype': subtype, 'publish': False, 'subtypes': subtypes})
 
 
+class ReloadHandler(handlers.SafeHandler):
+    """ Read the settings files again """
+
+    async def get(self):
+        mode = self.get_query_argument('mode', settings.config().mode)
+        await self.authenticate(mode)
+        if not reload_settings():
+            error = errors.ConfigurationError('settings.json')
+            self.return_error(error)
+            return
+        self.write({'reloaded': True, 'modes': sorted(settings.get_modes())})
+
+
 class SubtypeHandler(handlers.BaseHandler):
-    """ Return subtype information """
-    def get(self):
+    """ Return subtype information.
+        The number of entries per language of each subtype is included
+        once the catalogue has been loaded.
+    """
+    async def get(self):
         unpublished = self.get_query_argument('unpublished', False)
-        mode = self.get_query_argument('mode', settings.get('mode'))
+        mode = self.get_query_argument('mode', settings.config().mode)
         subtypes = get_subtypes(mode)
         logging.debug(' * Subtypes %s' % subtypes)
         if unpublished in [True, "true", "True"]:
-            all_subtypes = get_karp_subtypes(mode)
-            unpub_subtypes = list(all_subtypes.difference(subtypes))
-            self.write({'published': subtypes, 'unpublished': unpub_subtypes})
+            if not subtype_catalogue.has(mode):
+                # Only before the first refresh has finished
+                try:
+                    await refresh_catalogue(mode)
+                except errors.KarpError as error:
+                    self.return_error(error)
+                    return
+            unpub_subtypes = sorted(subtype_catalogue.subtypes(mode).difference(subtypes))
+            self.write({'published': subtypes, 'unpublished': unpub_subtypes,
+                        'counts': subtype_catalogue.get_counts(mode, subtypes + unpub_subtypes),
+                        'age': round(subtype_catalogue.age(mode))})
         else:
-            self.write({'subtypes': subtypes})
+            answer = {'subtypes': subtypes}
+            if subtype_catalogue.has(mode):
+                answer['counts'] = subtype_catalogue.get_counts(mode, subtypes)
+            self.write(answer)
+
+
+class MetricsHandler(handlers.BaseHandler):
+    """ Timings, errors and cache statistics, for Prometheus """
+    def get(self):
+        extra = []
+        for name, stats in [('search', search_cache.stats()), ('auth', handlers.auth_cache.stats()),
+                            ('hitcount', hit_counts.stats()), ('export', export_cache.stats())]:
+            extra.append(('cache_size', 'gauge', {'cache': name}, stats['size']))
+            extra.append(('cache_hits_total', 'counter', {'cache': name}, stats['hits']))
+            extra.append(('cache_misses_total', 'counter', {'cache': name}, stats['misses']))
+        extra.append(('cache_bytes', 'gauge', {'cache': 'search'}, search_cache.stats()['bytes']))
+        extra.append(('cache_bytes', 'gauge', {'cache': 'export'}, export_cache.stats()['bytes']))
+        calls = karp_calls.stats()
+        extra.append(('karp_inflight', 'gauge', {}, calls['inflight']))
+        extra.append(('karp_calls_total', 'counter', {}, calls['calls']))
+        extra.append(('karp_coalesced_total', 'counter', {}, calls['coalesced']))
+        disk = disk_cache.stats()
+        extra.append(('cache_size', 'gauge', {'cache': 'disk'}, disk['size']))
+        extra.append(('cache_hits_total', 'counter', {'cache': 'disk'}, disk['hits']))
+        extra.append(('cache_misses_total', 'counter', {'cache': 'disk'}, disk['misses']))
+        extra.append(('cache_bytes', 'gauge', {'cache': 'disk'}, disk['bytes']))
+        fragments = fragment_cache.stats()
+        extra.append(('cache_size', 'gauge', {'cache': 'fragment'}, fragments['size']))
+        extra.append(('cache_hits_total', 'counter', {'cache': 'fragment'}, fragments['hits']))
+        extra.append(('cache_misses_total', 'counter', {'cache': 'fragment'}, fragments['misses']))
+        extra.append(('cache_hit_ratio', 'gauge', {'cache': 'fragment'}, round(fragments['hit_rate'], 4)))
+        extra.append(('cache_bytes', 'gauge', {'cache': 'fragment'}, fragments['bytes']))
+        for name, stats in [('convert', convert_pool.stats()), ('pdf', pdf_pool.stats())]:
+            extra.append(('worker_pending', 'gauge', {'pool': name}, stats['pending']))
+            extra.append(('worker_rejected_total', 'counter', {'pool': name}, stats['rejected']))
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(metrics.render(extra))
 
 
 class ModeHandler(handlers.BaseHandler):
@@ -87,99 +209,478 @@ class ModeHandler(handlers.BaseHandler):
 class SearchHandler(handlers.BaseHandler):
     """ Return general information """
 
-    def get(self):
-        answer = []
+    async def get(self):
         logging.debug(' * Searching!')
-        mode = self.get_query_argument('mode', settings.get('mode'))
-        if not mode in settings.get_modes():
-            message = "Unknown mode: {}. Available: {}".format(mode, ', '.join(settings.get_modes()))
-            error = errors.ConfigurationError(message, code=400)
+        try:
+            search = Search(self.get_query_argument)
+        except (errors.ConfigurationError, errors.QueryError) as error:
+            self.return_error(error)
+            return
+        config = search.config
+        mode = search.mode
+
+        try:
+            await search.prepare(timings=self.timings)
+            params = search.params
+
+            if search.toformat == 'html':
+                if config.myurl:
+                    cssurl = config.myurl
+                else:
+                    cssurl = "{}://{}".format(self.request.protocol, self.request.host)
+                cssurl += "/css?mode=" + mode
+                stored = None
+                if not search.word and len(search.subtypes) == 1 and config.prerender_exports:
+                    stored = exports.find(mode, search.subtypes[0], search.lang)
+                if stored is None or not await self.write_stored(stored, mode, cssurl):
+                    await self.write_html(params, mode, cssurl)
+                return
+            if search.toformat == 'pdf':
+                await self.write_pdf(params, mode)
+                return
+            if search.toformat == 'ndjson':
+                data = search.from_mirror()
+                if data is None and search.size > config.export_pagesize:
+                    # Too big to get at once, send the pages as they arrive
+                    pages = fetch_pages(params, mode, with_total=True)
+                else:
+                    if data is None:
+                        data = await make_call(params, mode, timings=self.timings)
+                    pages = single_page(data)
+                await self.write_ndjson(pages, search.overflow, search.size, search.selected)
+                return
+
+            answer = await search.run(timings=self.timings)
+        except (errors.KarpError, errors.BusyError, errors.QueryError) as error:
+            self.return_error(error)
+            return
+
+        with self.timings.phase('serialize'):
+            self.write(answer)
+        self.set_timing_header()
+
+    async def write_ndjson(self, pages, overflow, size, selected):
+        """ Send the hits one entry per line, a page at a time.
+            `pages` yield the total number of hits, then the pages of hits.
+            Whether there were more hits than sent is told in the header X-Overflow.
+        """
+        # Errors in the first page can still be reported properly
+        with self.timings.phase('karp'):
+            total = await pages.__anext__()
+        try:
+            self.set_timing_header()
+            self.set_header('Content-Type', 'application/x-ndjson; charset=UTF-8')
+            self.set_header('X-Overflow', 'true' if overflow or total > size else 'false')
+            async for hits in pages:
+                with self.timings.phase('serialize'):
+                    lines = ''.join(tornado.escape.json_encode(projection.project(hit.get('_source', {}), selected))
+                                    + '\n' for hit in hits)
+                self.write(lines)
+                await self.flush()
+        except errors.KarpError:
+            # Too late to send an error, just stop
+            logging.exception('Search interrupted')
+            self.request.connection.close()
+        finally:
+            await pages.aclose()
+
+    async def write_html(self, params, mode, cssurl):
+        """ Send the html export in chunks, as the pages arrive from Karp.
+            Exports that are small enough are kept, so that the next
+            download of the same export is sent (compressed) at once.
+        """
+        key = (mode, params['q'], params.get('sort', ''), params['size'], cssurl)
+        export = export_cache.get(key)
+        if export is not None:
+            await self.write_export(key, export)
+            return
+        # Refuse at once if the conversion workers are busy
+        with convert_pool.slot():
+            await self.stream_html(key, params, mode, cssurl)
+
+    async def stream_html(self, key, params, mode, cssurl):
+        """ Fetch, convert and send an html export, and cache it if it is small enough """
+        config = settings.config(mode)
+        karpmode = config.mode
+        maxbytes = config.export_cache_maxbytes
+        pages = fetch_pages(params, mode)
+        # Errors in the first page can still be reported properly
+        with self.timings.phase('karp'):
+            first = await pages.__anext__()
+        self.set_timing_header()
+        self.set_header('Content-Type', 'text/html; charset=UTF-8')
+        html = convert.header(karpmode, cssurl).encode()
+        self.write(html)
+        # The export so far, as long as it is small enough to be cached
+        parts = [html]
+        length = len(html)
+        try:
+            hits = first
+            while True:
+                jobs = convert_chunks(hits, mode)
+                try:
+                    for job in jobs:
+                        with self.timings.phase('convert'):
+                            html = await job
+                        self.write(html)
+                        if parts is not None:
+                            length += len(html)
+                            if length <= maxbytes:
+                                parts.append(html)
+                            else:
+                                parts = None
+                        await self.flush()
+                finally:
+                    for job in jobs:
+                        job.cancel()
+                hits = await pages.__anext__()
+        except StopAsyncIteration:
+            pass
+        except (errors.KarpError, errors.BusyError):
+            # Too late to send an error, just stop
+            logging.exception('Export interrupted')
+            self.request.connection.close()
+            return
+        finally:
+            await pages.aclose()
+        html = convert.footer(karpmode).encode()
+        self.write(html)
+        if parts is not None and length + len(html) <= maxbytes:
+            parts.append(html)
+            export = b''.join(parts)
+            export_cache.set(key, {None: export}, config.cache_ttl, size=len(export))
+
+    async def write_pdf(self, params, mode):
+        """ Send the export as a pdf document, rendered by the pdf workers """
+        karpmode = settings.config(mode).mode
+        # Refuse at once if the workers are busy, before asking Karp for everything
+        with pdf_pool.slot():
+            objs = []
+            with self.timings.phase('karp'):
+                async for hits in fetch_pages(params, mode):
+                    objs.extend(hit['_source'] for hit in hits)
+            with self.timings.phase('pdf'):
+                body = await pdf_pool.run(convert.pdf_export, objs, karpmode)
+        self.set_timing_header()
+        self.set_header('Content-Type', 'application/pdf')
+        self.set_header('Content-Disposition', 'inline; filename="{}.pdf"'.format(mode))
+        self.write(body)
+
+    async def write_stored(self, stored, mode, cssurl):
+        """ Send an export rendered in advance.
+            Return False if it has been removed since it was found.
+        """
+        config = settings.config(mode)
+        key = (mode, stored.path, cssurl)
+        export = export_cache.get(key)
+        if export is None:
+            try:
+                export_file = open(stored.path, 'rb')
+            except FileNotFoundError:
+                return False
+            header = convert.header(config.mode, cssurl).encode()
+            with export_file:
+                size = os.fstat(export_file.fileno()).st_size
+                if size + len(header) > config.export_cache_maxbytes:
+                    # Too big to keep in memory, send it as it is read
+                    self.set_header('Content-Type', 'text/html; charset=UTF-8')
+                    self.write(header)
+                    chunk = export_file.read(exports.CHUNK_SIZE)
+                    while chunk:
+                        self.write(chunk)
+                        await self.flush()
+                        chunk = export_file.read(exports.CHUNK_SIZE)
+                    return True
+                with self.timings.phase('read'):
+                    export = {None: header + export_file.read()}
+            export_cache.set(key, export, config.cache_ttl, size=len(export[None]))
+        await self.write_export(key, export)
+        return True
+
+    async def write_export(self, key, export):
+        """ Send a cached export, compressed if the client accepts it.
+            Each compressed version is made once, in a thread so that the
+            IOLoop is not blocked, and kept with the export.
+        """
+        encoding = compression.choose(self.request.headers.get('Accept-Encoding', ''))
+        if encoding is not None and encoding not in export:
+            loop = asyncio.get_event_loop()
+            with self.timings.phase('compress'):
+                data = await loop.run_in_executor(None, compression.compress, export[None], encoding)
+            if encoding not in export:
+                export[encoding] = data
+                export_cache.grow(key, len(data))
+        self.set_timing_header()
+        self.set_header('Content-Type', 'text/html; charset=UTF-8')
+        if encoding is not None:
+            self.set_header('Content-Encoding', encoding)
+        self.write(export[encoding])
+
+
+class BatchSearchHandler(handlers.BaseHandler):
+    """ Run several json searches at once.
+        Takes {"searches": [{"id": .., "q": .., "mode": .., ...}, ...]}, with
+        the same arguments as /search, and returns {"results": {id: answer}}.
+        A search that fails gets {"error": .., "status": ..} as its answer.
+    """
+
+    async def post(self):
+        try:
+            batch = Batch(self.request.body)
+        except errors.QueryError as error:
             self.return_error(error)
             return
+        with self.timings.phase('search'):
+            results = await batch.run()
+        with self.timings.phase('serialize'):
+            self.write({'results': results})
+        self.set_timing_header()
+
+
+class Batch(object):
+    """ A batch of searches, read from json """
+
+    def __init__(self, body):
+        try:
+            specs = json.loads(body.decode('utf-8'))['searches']
+        except (UnicodeDecodeError, ValueError, TypeError, KeyError):
+            raise errors.QueryError('Expected json: {"searches": [...]}')
+        if not isinstance(specs, list) or not all(isinstance(spec, dict) for spec in specs):
+            raise errors.QueryError('"searches" should be a list of objects')
+        maxsize = settings.config().batch_maxsize
+        if len(specs) > maxsize:
+            raise errors.QueryError('At most {} searches per batch'.format(maxsize))
+        self.searches = collections.OrderedDict()
+        for ix, spec in enumerate(specs):
+            search_id = str(spec.get('id', ix))
+            if search_id in self.searches:
+                raise errors.QueryError('Duplicate id: {}'.format(search_id))
+            # All arguments are checked before anything is searched
+            try:
+                args = {key: batch_argument(value) for key, value in spec.items() if key != 'id'}
+                search = Search(args.get)
+                if search.toformat:
+                    raise errors.QueryError('Only json results in a batch')
+            except (errors.ConfigurationError, errors.QueryError) as error:
+                search = error
+            self.searches[search_id] = search
+
+    async def run(self):
+        """ Run the searches, `batch_concurrency` at a time """
+        limit = asyncio.Semaphore(settings.config().batch_concurrency)
+
+        async def run(search):
+            if isinstance(search, Exception):
+                return {'error': search.message, 'status': search.code}
+            async with limit:
+                try:
+                    await search.prepare()
+                    return await search.run()
+                except (errors.KarpError, errors.QueryError) as error:
+                    return {'error': error.message, 'status': error.code}
+
+        answers = await asyncio.gather(*[run(search) for search in self.searches.values()])
+        return collections.OrderedDict(zip(self.searches.keys(), answers))
 
-        toformat = self.get_query_argument('format', False)
-        inp_subtypes = self.get_query_argument('subtypes', [])
+
+def batch_argument(value):
+    """ An argument from a batch, as it would be written in a query string """
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, list):
+        return ','.join(batch_argument(item) for item in value)
+    if isinstance(value, (str, int, float)):
+        return str(value)
+    raise errors.QueryError('Bad argument: {}'.format(json.dumps(value)))
+
+
+class Search(object):
+    """ One search, with its arguments checked.
+        `get(name, default)` reads the arguments, from the query string
+        or from a search in a batch.
+        Raises a QueryError (or a ConfigurationError) for bad arguments.
+    """
+
+    def __init__(self, get):
+        self.mode = get('mode', settings.config().mode)
+        if not self.mode in settings.get_modes():
+            message = "Unknown mode: {}. Available: {}".format(self.mode, ', '.join(settings.get_modes()))
+            raise errors.ConfigurationError(message, code=400)
+        config = self.config = settings.config(self.mode)
+
+        self.toformat = get('format', False)
+        if self.toformat == 'pdf' and config.mode not in convert.mode_pdf:
+            raise errors.QueryError('Pdf export is not available for {}'.format(self.mode))
+        inp_subtypes = get('subtypes', [])
         if inp_subtypes:
             inp_subtypes = inp_subtypes.split(',')
         logging.debug('inp_subtypes %s', inp_subtypes)
-        word = self.get_query_argument('q', '')
-        contains = self.get_query_argument('contains', '') in [True, 'true', 'True']
-        logging.debug('word %s', word)
-        lang = self.get_query_argument('lang', 'sv')
-        if lang not in settings.get('languages', mode):
-            message = "Unknown language: {}. Available: {}".format(lang, ', '.join(settings.get('languages', mode)))
-            error = errors.QueryError(message)
-            self.return_error(error)
-            return
+        self.word = get('q', '')
+        self.contains = get('contains', '') in [True, 'true', 'True']
+        self.token = get('cursor', '')
+        self.paginate = bool(self.token) or get('paginate', '') in [True, 'true', 'True']
+        logging.debug('word %s', self.word)
+        self.lang = get('lang', 'sv')
+        if self.lang not in config.languages:
+            message = "Unknown language: {}. Available: {}".format(self.lang, ', '.join(config.languages))
+            raise errors.QueryError(message)
+        self.fields = projection.parse(get('fields', ''))
+        self.selected = projection.tree(self.fields) if self.fields else None
 
-        if toformat in ['html', 'pdf']:
-            size = int(settings.get('maxsize_export', mode))
+        if self.toformat in ['html', 'pdf']:
+            self.size = int(config.maxsize_export)
         else:
-            size = int(self.get_query_argument('size', settings.get('maxsize', mode)))
+            try:
+                self.size = int(get('size', config.maxsize))
+            except (TypeError, ValueError):
+                raise errors.QueryError('Bad size')
 
-        subtypes = filter_public_subtypes(inp_subtypes, mode)
-        logging.debug(' * Subtypes %s', subtypes)
-        if not subtypes:
+        self.subtypes = filter_public_subtypes(inp_subtypes, self.mode)
+        logging.debug(' * Subtypes %s', self.subtypes)
+        if not self.subtypes:
             logging.warning(' * No public subtypes!')
             message = "Subtype(s) {} not public".format(', '.join(inp_subtypes))
-            error = errors.QueryError(message)
-            self.return_error(error)
-            return
+            raise errors.QueryError(message)
+        self.overflow = False
+        self.params = None
 
-        url = settings.karp + '/query?%s'
-
-        params = {'resource': settings.get('resource', mode),
-                  'mode': settings.get('mode', mode),
-                  'size': size}
-
-        overflow = False
-        if not word and toformat not in ['html', 'pdf']:
-            word = limit_query(subtypes, lang, mode)
-            if word:
-                overflow = True
-
-        params['q'] = build_query(word, subtypes, contains, lang, mode)
-        if lang != settings.get('sourcelanguage', mode):
-            params['sort'] = settings.get('targetsort', mode)
-
-        data = make_call(url, params, mode)
-        if toformat == 'html':
-            if settings.get('myurl', mode):
-                cssurl = settings.get('myurl', mode)
-            else:
-                cssurl = "{}://{}".format(self.request.protocol, self.request.host)
-            cssurl += "/css?mode=" + mode
-            html = convert.format_posts(data, settings.get('mode', mode), toformat='html', css=cssurl)
-            self.write(html)
-            return
+    async def prepare(self, timings=None):
+        """ Make the query to Karp. Browsing too many entries is limited to
+            the first letter, unless the search is paginated.
+        """
+        config = self.config
+        if not self.word and self.toformat not in ['html', 'pdf'] and not self.paginate:
+            with metrics.timed(timings, 'probe'):
+                self.word = await limit_query(self.subtypes, self.lang, self.mode)
+            if self.word:
+                self.overflow = True
+
+        self.params = {'resource': config.resource,
+                       'mode': config.mode,
+                       'size': self.size,
+                       'q': build_query(self.word, self.subtypes, self.contains, self.lang, self.mode)}
+        self.params['sort'] = sort_order(self.lang == config.sourcelanguage, self.mode)
+        if self.fields and self.toformat not in ['html', 'pdf']:
+            # Let Karp leave out the other fields
+            self.params['show'] = ','.join(self.fields)
+
+    def from_mirror(self):
+        """ The answer from the mirror, or None """
+        return search_mirror(self.word, self.subtypes, self.contains, self.lang, self.mode, self.size)
+
+    async def run(self, timings=None):
+        """ The json answer of a prepared search """
+        if self.paginate:
+            total, entries, next_cursor = await search_page(self.word, self.subtypes, self.contains, self.lang,
+                                                            self.mode, self.params, self.token, timings=timings)
+            return {'result': [projection.project(entry, self.selected) for entry in entries],
+                    'overflow': next_cursor is not None,
+                    'total': total,
+                    'next': next_cursor}
+        data = self.from_mirror()
+        if data is None:
+            data = await make_call(self.params, self.mode, timings=timings)
 
         total = data.get('hits', {}).get('total', 0)
         hits = data.get('hits', {}).get('hits', [])
-        for ans in hits:
-            source = ans.get('_source', {})
-            answer.append(source)
-
-        logging.debug('overflow? %s > %s', total, size)
-        self.write({'result': answer, 'overflow': overflow or total > size})
+        answer = [projection.project(hit.get('_source', {}), self.selected) for hit in hits]
+        logging.debug('overflow? %s > %s', total, self.size)
+        return {'result': answer, 'overflow': self.overflow or total > self.size}
 
 
-def make_call(url, params, mode):
-    data = urllib.parse.urlencode(params)
+async def make_call(params, mode, call='query', timings=None):
+    """ Send a query to Karp. Search results are cached in memory and on
+        disk, and identical concurrent calls share one request.
+        The time spent waiting for Karp is added to `timings`.
+    """
     logging.debug('data %s', params)
-    full_url = url % data
-    logging.debug(str(full_url))
-    req = urllib.request.Request(full_url)
-    add_credentials(req, mode)
 
-    response = urllib.request.urlopen(req)
-    return json.loads(response.read().decode())
+    def fetch():
+        return karp.call(call, params, mode)
+
+    if call != 'query':
+        key = (mode, call, tuple(sorted(params.items())))
+        return await karp_calls.do(key, fetch)
+
+    def fetch_sized():
+        return karp.call(call, params, mode, with_size=True)
+
+    key = (mode, params['resource'], params['mode'], params['q'], params.get('start', 0),
+           params['size'], params.get('sort', ''), params.get('show', ''))
+    data = search_cache.get(key)
+    if data is None:
+        version = published.registry.digest(mode)
+        with metrics.timed(timings, 'disk'):
+            data, size = disk_cache.get(key, version, with_size=True)
+        if data is None:
+            with metrics.timed(timings, 'karp'):
+                data, size = await karp_calls.do(key, fetch_sized)
+            disk_cache.set(key, version, data, settings.config(mode).disk_cache_ttl)
+        # Sized by the json, the decoded answer takes a few times more memory
+        search_cache.set(key, data, settings.config(mode).cache_ttl, size=size)
+    return data
+
+
+async def single_page(data):
+    """ A search answer, as pages like from `fetch_pages(params, mode, with_total=True)` """
+    yield data.get('hits', {}).get('total', 0)
+    yield data.get('hits', {}).get('hits', [])
+
+
+async def fetch_pages(params, mode, with_total=False):
+    """ Fetch the hits of a big query in windows of `export_pagesize` entries.
+        Up to `export_concurrency` windows are fetched at the same time.
+        Yields one list of hits per window, in order, after the total number
+        of hits if `with_total` is set.
+    """
+    config = settings.config(mode)
+    pagesize = int(config.export_pagesize)
+    concurrency = int(config.export_concurrency)
+    timeout = config.karp_export_timeout
+    limit = int(params['size'])
+
+    def fetch(start, end):
+        page = dict(params, start=start, size=min(pagesize, end - start))
+        return asyncio.ensure_future(karp.call('query', page, mode, timeout=timeout))
+
+    first = await fetch(0, limit)
+    if with_total:
+        yield int(first.get('hits', {}).get('total', 0))
+    yield first.get('hits', {}).get('hits', [])
+    total = min(int(first.get('hits', {}).get('total', 0)), limit)
+    starts = iter(range(pagesize, total, pagesize))
+    pending = collections.deque(fetch(start, total) for start in itertools.islice(starts, concurrency))
+    try:
+        while pending:
+            data = await pending.popleft()
+            start = next(starts, None)
+            if start is not None:
+                pending.append(fetch(start, total))
+            yield data.get('hits', {}).get('hits', [])
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def sort_order(source, mode):
+    """ The order of the hits of a search in the source language if `source`,
+        otherwise the target language, sent to Karp.
+        Pages fetched separately only line up if the order is total, so the
+        tiebreaker (if any) comes last.
+    """
+    config = settings.config(mode)
+    field = config.sourcesort if source else config.targetsort
+    if config.sort_tiebreaker:
+        return '{},{}'.format(field, config.sort_tiebreaker)
+    return field
 
 
 def build_query(word, subtypes, contains, lang, mode):
     """ Construct the query string to Karp """
-    wordfield = settings.get('baseform.search', mode)
-    if lang != settings.get('sourcelanguage', mode):
-        wordfield = settings.get('targetform.search', mode)
+    config = settings.config(mode)
+    wordfield = config.baseform_search
+    if lang != config.sourcelanguage:
+        wordfield = config.targetform_search
 
     if word and contains:
         word = word.lower()
@@ -203,65 +704,425 @@ def build_query(word, subtypes, contains, lang, mode):
     return query
 
 
-def limit_query(subtypes, lang, mode):
-    url = settings.karp + '/query?%s'
-    params = {'resource': settings.get('resource', mode),
-              'mode': settings.get('mode', mode),
-              'size': 0}
-    params['q'] = build_query('', subtypes, False, lang, mode)
-    data = make_call(url, params, mode)
-    if int(data['hits']['total']) > settings.get('overflowsize'):
+async def limit_query(subtypes, lang, mode):
+    """ If browsing the subtypes gives too many hits, return the letter to
+        which the search should be limited
+    """
+    data = search_mirror('', subtypes, False, lang, mode, 0)
+    if data is not None:
+        total = data['hits']['total']
+    else:
+        total = hit_counts.get(mode, lang, subtypes)
+        if total is None:
+            total = await count_hits(subtypes, lang, mode)
+    if total > settings.config(mode).overflowsize:
         return settings.get_first_letter(lang, mode)
     return ''
 
 
+async def count_hits(subtypes, lang, mode):
+    """ Ask Karp how many entries there are in the subtypes, and remember it """
+    config = settings.config(mode)
+    params = {'resource': config.resource,
+              'mode': config.mode,
+              'size': 0,
+              'q': build_query('', subtypes, False, lang, mode)}
+    data = await karp.call('query', params, mode)
+    total = int(data['hits']['total'])
+    hit_counts.set(mode, lang, subtypes, total)
+    return total
 
-def get_subtypes(mode):
-    """ Read all subtypes for this mode from file """
-    return [s.strip() for s in open(settings.get('subtypes', mode), encoding='utf-8').readlines() if s]
+
+async def precompute_hit_counts(subtype, mode):
+    """ Count the hits of a newly published subtype, alone and together
+        with all other published subtypes
+    """
+    for lang in settings.config(mode).languages:
+        for subtypes in [[subtype], published.registry.get(mode)]:
+            try:
+                await count_hits(subtypes, lang, mode)
+            except errors.KarpError as error:
+                logging.warning('Could not count hits for %s: %s', subtypes, error.message)
+
+
+async def refresh_hit_counts():
+    """ Update all remembered hit counts """
+    for mode, lang, subtypes in hit_counts.keys():
+        try:
+            await count_hits(subtypes, lang, mode)
+        except errors.KarpError as error:
+            logging.warning('Could not count hits for %s: %s', list(subtypes), error.message)
+
+
+def start_hit_counts():
+    """ Refresh the hit counts periodically """
+    interval = settings.config().hitcount_refresh * 1000
+    tornado.ioloop.PeriodicCallback(refresh_hit_counts, interval).start()
+
+
+def convert_chunks(hits, mode):
+    """ Start converting a page of hits to html in the conversion workers,
+        `export_chunksize` entries per job. Return the jobs, in order.
+    """
+    config = settings.config(mode)
+    karpmode = config.mode
+    chunksize = int(config.export_chunksize)
+    return [asyncio.ensure_future(convert_chunk(hits[ix:ix+chunksize], karpmode))
+            for ix in range(0, len(hits), chunksize)]
+
+
+async def convert_chunk(hits, karpmode):
+    """ The html of a list of hits, encoded. Entries that have been converted
+        before, and not changed since, are taken from the fragment cache.
+    """
+    if fragment_cache.maxbytes <= 0:
+        html = await convert_pool.run(convert.entries, [hit['_source'] for hit in hits], karpmode)
+        return html.encode()
+    digests = [entry_digest(hit['_source']) for hit in hits]
+    html = [fragment_cache.get((karpmode, hit['_id']), digest) if '_id' in hit else None
+            for hit, digest in zip(hits, digests)]
+    missing = [ix for ix, fragment in enumerate(html) if fragment is None]
+    if missing:
+        fragments = await convert_pool.run(convert.fragments, [hits[ix]['_source'] for ix in missing], karpmode)
+        for ix, fragment in zip(missing, fragments):
+            fragment = html[ix] = fragment.encode()
+            if '_id' in hits[ix]:
+                fragment_cache.set((karpmode, hits[ix]['_id']), digests[ix], fragment)
+    return b''.join(html)
+
+
+def entry_digest(source):
+    """ Identifies the content of an entry """
+    data = json.dumps(source, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.blake2b(data.encode(), digest_size=16).digest()
+
+
+async def render_export(params, mode):
+    """ The html of all entries of a query, without the html header """
+    parts = []
+    async for hits in fetch_pages(params, mode):
+        jobs = convert_chunks(hits, mode)
+        try:
+            for job in jobs:
+                parts.append(await job)
+        finally:
+            for job in jobs:
+                job.cancel()
+    parts.append(convert.footer(settings.config(mode).mode).encode())
+    return b''.join(parts)
+
+
+async def prerender_export(subtype, lang, mode):
+    """ Render the html export of a published subtype in one language, and store it """
+    key = (mode, subtype, lang)
+    if key in rendering_exports:
+        return
+    rendering_exports.add(key)
+    try:
+        config = settings.config(mode)
+        params = {'resource': config.resource,
+                  'mode': config.mode,
+                  'size': int(config.maxsize_export),
+                  'q': build_query('', [subtype], False, lang, mode),
+                  'sort': sort_order(lang == config.sourcelanguage, mode)}
+        body = await render_export(params, mode)
+        # The subtype may have been unpublished while it was rendered
+        if subtype in published.registry.get(mode):
+            exports.store(mode, subtype, lang, body)
+    except (errors.KarpError, errors.BusyError, OSError) as error:
+        logging.error('Could not render the export of %s (%s): %s', subtype, lang, error)
+    finally:
+        rendering_exports.discard(key)
+
+
+async def prerender_exports(subtype, mode):
+    """ Render the html exports of a published subtype, in all languages """
+    for lang in settings.config(mode).languages:
+        await prerender_export(subtype, lang, mode)
+
+
+async def refresh_exports():
+    """ Render the exports of all published subtypes again, to get changes
+        made in Karp. Remove the exports of unpublished subtypes.
+    """
+    for mode in settings.get_modes():
+        if not settings.config(mode).prerender_exports:
+            continue
+        subtypes = published.registry.get(mode)
+        exports.remove_unpublished(mode, subtypes)
+        for subtype in subtypes:
+            await prerender_exports(subtype, mode)
+
+
+def start_exports():
+    """ Render the exports now, and then periodically.
+        When there are several worker processes, the first one does it for all.
+    """
+    if tornado.process.task_id() not in (None, 0):
+        return
+    tornado.ioloop.IOLoop.current().spawn_callback(refresh_exports)
+    interval = settings.config().export_refresh * 1000
+    tornado.ioloop.PeriodicCallback(refresh_exports, interval).start()
+
+
+def search_mirror(word, subtypes, contains, lang, mode, size):
+    """ Answer a search from the local mirror, in the same format as Karp.
+        Return None if there is no mirror for the mode.
+    """
+    local = mirror.mirrors.get(mode)
+    if local is None or (contains and word and local.ngrams is None):
+        return None
+    source = lang == settings.config(mode).sourcelanguage
+    total, entries = local.search(word, subtypes, source, size, contains=contains)
+    return {'hits': {'total': total, 'hits': [{'_source': entry} for entry in entries]}}
+
+
+async def search_page(word, subtypes, contains, lang, mode, params, token, timings=None):
+    """ One page (`params['size']` hits) of a paginated search, starting at the
+        cursor `token` (at the beginning if empty).
+        In the mirror, the page starts after the sort key of the last hit of
+        the previous page, so every page costs the same. Karp is asked from
+        the offset of the previous page.
+        Return the total number of hits, the entries and the cursor to the
+        next page (None for the last page).
+    """
+    query = cursor.query_key(mode, params)
+    position = cursor.decode(token, query) if token else cursor.START
+    size = int(params['size'])
+    local = mirror.mirrors.get(mode)
+    if local is not None and not (contains and word and local.ngrams is None):
+        source = lang == settings.config(mode).sourcelanguage
+        # Keys from another version of the mirror mean nothing, use the offset then
+        if position['after'] is not None and position['mirror'] == local.version:
+            total, entries, last = local.page(word, subtypes, source, size, contains=contains,
+                                              after=position['after'])
+        else:
+            total, entries, last = local.page(word, subtypes, source, size, contains=contains,
+                                              start=position['start'])
+        next_cursor = None
+        if last is not None:
+            next_cursor = cursor.encode(query, position['start'] + len(entries), last, local.version)
+        return total, entries, next_cursor
+
+    start = position['start']
+    data = await make_call(dict(params, start=start), mode, timings=timings)
+    total = int(data.get('hits', {}).get('total', 0))
+    entries = [hit.get('_source', {}) for hit in data.get('hits', {}).get('hits', [])]
+    next_cursor = None
+    if entries and start + len(entries) < total:
+        next_cursor = cursor.encode(query, start + len(entries))
+    return total, entries, next_cursor
+
+
+async def refresh_mirror(mode):
+    """ Download all published entries of the mode into a new mirror """
+    if mode in refreshing_mirrors:
+        return
+    refreshing_mirrors.add(mode)
+    try:
+        while True:
+            version = published.registry.version(mode)
+            hits, target_order = await download_published(mode)
+            if hits is None:
+                # Too many entries, searches go to Karp
+                mirror.mirrors.pop(mode, None)
+                break
+            # Start over if the subtypes were changed during the download
+            if version == published.registry.version(mode):
+                budget = settings.config(mode).ngram_memory_mb * 1024 * 1024
+                mirror.mirrors[mode] = mirror.Mirror(mode, hits, target_order, ngram_budget=budget)
+                break
+    except errors.KarpError as error:
+        logging.error('Could not update the mirror of %s: %s', mode, error.message)
+    finally:
+        refreshing_mirrors.discard(mode)
 
 
-def update_subtypes(subtypes, mode):
-    """ Update the subtypes file """
-    open(settings.get('subtypes', mode), encoding='utf-8', mode='w').write('\n'.join(subtypes))
+async def download_published(mode):
+    """ Fetch all published entries of the mode, sorted by the source language, and the
+        ids of the entries sorted by the target language.
+        Return None, None if there are more than `mirror_maxsize` entries.
+    """
+    config = settings.config(mode)
+    subtypes = published.registry.get(mode)
+    params = {'resource': config.resource,
+              'mode': config.mode,
+              'size': int(config.mirror_maxsize),
+              'q': build_query('', subtypes, False, config.sourcelanguage, mode),
+              'sort': sort_order(True, mode)}
+    hits = []
+    pages = fetch_pages(params, mode, with_total=True)
+    try:
+        total = await pages.__anext__()
+        if total > params['size']:
+            logging.error('Not mirroring %s: %s entries, more than mirror_maxsize (%s)',
+                          mode, total, params['size'])
+            return None, None
+        async for page in pages:
+            hits.extend(page)
+    finally:
+        await pages.aclose()
+    target_order = []
+    params['sort'] = sort_order(False, mode)
+    params['show'] = '_id'
+    async for page in fetch_pages(params, mode):
+        target_order.extend(hit['_id'] for hit in page)
+    return hits, target_order
 
 
-def get_karp_subtypes(mode):
-    """ Ask Karp about all available subtypes """
-    logging.debug(' * Searching!')
-    url = settings.karp + '/statlist?%s'
-    size = settings.get('overflowsize', 1000)
-    params = {'resource': settings.get('resource', mode),
-              'mode': settings.get('mode', mode),
-              'size': size,
+def mirrored_modes():
+    " All modes configured to have a mirror "
+    return [mode for mode in settings.get_modes() if settings.config(mode).mirror]
+
+
+def refresh_mirrors():
+    """ Start refreshing the mirror of all modes that should have one """
+    for mode in mirrored_modes():
+        tornado.ioloop.IOLoop.current().spawn_callback(refresh_mirror, mode)
+
+
+def start_mirrors():
+    """ Load the mirrors now, and then periodically """
+    if not mirrored_modes():
+        return
+    published.registry.on_change(mirror_changed)
+    refresh_mirrors()
+    interval = settings.config().mirror_refresh * 1000
+    tornado.ioloop.PeriodicCallback(refresh_mirrors, interval).start()
+
+
+def mirror_changed(mode):
+    """ The published subtypes have changed.
+        Stop using the mirror until it has been reloaded.
+    """
+    if mode in mirrored_modes():
+        mirror.mirrors.pop(mode, None)
+        tornado.ioloop.IOLoop.current().spawn_callback(refresh_mirror, mode)
+
+
+def reload_settings():
+    """ Read the settings files again, keep the old settings if they are broken """
+    try:
+        settings.load()
+    except (OSError, ValueError):
+        logging.exception('Could not reload the settings')
+        return False
+    published.registry.load_all()
+    search_cache.clear()
+    export_cache.clear()
+    resize_caches()
+    return True
+
+
+def resize_caches():
+    """ Apply the cache sizes of the settings. Sizes of worker pools, the
+        disk cache and the Karp client need a restart.
+    """
+    config = settings.config()
+    search_cache.maxsize = int(config.cache_size)
+    search_cache.maxbytes = int(config.cache_mb) * 1024 * 1024
+    handlers.auth_cache.maxsize = int(config.auth_cache_size)
+    export_cache.maxsize = int(config.export_cache_size)
+    export_cache.maxbytes = int(config.export_cache_mb) * 1024 * 1024
+    fragment_cache.maxbytes = int(config.fragment_cache_mb) * 1024 * 1024
+    hit_counts.maxsize = int(config.hitcount_size)
+
+
+def check_settings():
+    """ Reload the settings if the files have been changed """
+    if settings.changed():
+        logging.info('The settings have changed, reloading')
+        reload_settings()
+
+
+def start_settings_check():
+    """ Check the settings files for changes periodically, so that every
+        worker process picks them up
+    """
+    interval = settings.config().settings_check_interval * 1000
+    tornado.ioloop.PeriodicCallback(check_settings, interval).start()
+
+
+def get_subtypes(mode):
+    """ All published subtypes for this mode """
+    return list(published.registry.get(mode))
+
+
+async def count_subtypes(lang, mode):
+    """ Ask Karp about all available subtypes, and how many entries
+        each of them has in the language
+    """
+    config = settings.config(mode)
+    params = {'resource': config.resource,
+              'mode': config.mode,
+              'size': config.overflowsize,
               'buckets': 'subtype'}
-    params['q'] = build_query('', '', False, settings.get('sourcelanguage'), mode)
-    data = urllib.parse.urlencode(params)
-    logging.debug('data %s', params)
-    full_url = url % data
-    logging.debug(str(full_url))
-    req = urllib.request.Request(full_url)
-    add_credentials(req, mode)
-    response = urllib.request.urlopen(req)
-    data = json.loads(response.read().decode())
-    res = set()
-    for subtype in data['stat_table']:
-        if subtype[0]:
-            res.add(subtype[0])
-    return res
+    params['q'] = build_query('', '', False, lang, mode)
+    data = await make_call(params, mode, call='statlist')
+    return data['stat_table']
+
+
+async def refresh_catalogue(mode):
+    """ Count the entries of all subtypes of the mode, in all languages """
+    counts = {}
+    for lang in settings.config(mode).languages:
+        catalogue.add_counts(counts, lang, await count_subtypes(lang, mode))
+    subtype_catalogue.set(mode, counts)
+
+
+async def refresh_catalogues():
+    """ Update the subtype catalogues of all modes """
+    for mode in settings.get_modes():
+        try:
+            await refresh_catalogue(mode)
+        except errors.KarpError as error:
+            logging.warning('Could not update the subtypes of %s: %s', mode, error.message)
+
+
+def start_catalogues():
+    """ Load the subtype catalogues now, and then periodically """
+    tornado.ioloop.IOLoop.current().spawn_callback(refresh_catalogues)
+    interval = settings.config().catalogue_refresh * 1000
+    tornado.ioloop.PeriodicCallback(refresh_catalogues, interval).start()
+
+
+async def compact_disk_cache():
+    """ Save when results in the disk cache were used. The first worker
+        process also removes old results. Done in a thread.
+    """
+    if disk_cache.name in compacting:
+        return
+    compacting.add(disk_cache.name)
+    try:
+        loop = asyncio.get_event_loop()
+        if tornado.process.task_id() in (None, 0):
+            versions = {}
+            for mode in settings.get_modes():
+                try:
+                    versions[mode] = published.registry.digest(mode)
+                except errors.ConfigurationError as error:
+                    logging.error(error.message)
+            await loop.run_in_executor(None, disk_cache.compact, versions, disk_cache.take_used())
+        else:
+            await loop.run_in_executor(None, disk_cache.save_used, disk_cache.take_used())
+    finally:
+        compacting.discard(disk_cache.name)
+
+
+def start_disk_cache():
+    """ Compact the disk cache now, and then periodically """
+    if not disk_cache.enabled():
+        return
+    tornado.ioloop.IOLoop.current().spawn_callback(compact_disk_cache)
+    interval = settings.config().disk_cache_compact * 1000
+    tornado.ioloop.PeriodicCallback(compact_disk_cache, interval).start()
 
 
 def filter_public_subtypes(wanted, mode):
     """ Get the subtypes as specified by the user """
-    existing_subtypes = set(get_subtypes(mode))
+    existing_subtypes = set(published.registry.get(mode))
     if not wanted:
         return list(existing_subtypes)
     logging.debug(' * Intersection %s / %s', existing_subtypes, wanted)
     return list(existing_subtypes.intersection(set(wanted)))
 
-
-def add_credentials(request, mode):
-    """ Prepare a request by adding login credentials """
-    credentials = ('%s:%s' % (settings.get('username', mode), settings.get('password', mode)))
-    encoded_credentials = base64.b64encode(credentials.encode('ascii'))
-    request.add_header('Authorization', 'Basic %s' % encoded_credentials.decode("ascii"))
@@ -0,0 +1,91 @@
+""" Pools of worker processes (or threads), for work that would block the IOLoop for too long """
+import asyncio
+import concurrent.futures
+import contextlib
+import logging
+import time
+
+import utils.errors as errors
+import utils.metrics as metrics
+
+
+def timed_call(func, args):
+    """ Call `func(*args)` in a worker, return the time it took and the result """
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+class WorkerPool(object):
+    """ Runs functions in `workers` processes, or threads if `kind` is
+        'thread', started when first needed.
+        Jobs hold a slot from when they are accepted until they are done.
+        When all `workers` + `queue_size` slots are taken, new jobs are
+        refused with a BusyError, telling the client to come back after
+        `retry_after` seconds.
+    """
+
+    def __init__(self, name, workers, queue_size, retry_after, kind='process'):
+        self.name = name
+        self.kind = kind
+        self.workers = workers
+        self.queue_size = queue_size
+        self.retry_after = retry_after
+        self.executor = None
+        self.pending = 0
+        self.rejected = 0
+
+    def get_executor(self):
+        if self.executor is None:
+            if self.kind == 'thread':
+                self.executor = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix=self.name)
+            else:
+                # Started with the default start method, which route.py sets to spawn
+                self.executor = concurrent.futures.ProcessPoolExecutor(self.workers)
+            logging.info('Started %s %s %s workers', self.workers, self.name, self.kind)
+        return self.executor
+
+    @contextlib.contextmanager
+    def slot(self):
+        """ Reserve a place in the queue, or raise a BusyError """
+        if self.pending >= self.workers + self.queue_size:
+            self.rejected += 1
+            raise errors.BusyError('Too many {} jobs, try again later'.format(self.name), self.retry_after)
+        self.pending += 1
+        try:
+            yield
+        finally:
+            self.pending -= 1
+
+    async def run(self, func, *args):
+        """ Run `func(*args)` in a worker and return the result.
+            For processes, the function and its arguments must be picklable.
+            The time spent waiting for a worker and working is measured.
+        """
+        start = time.perf_counter()
+        loop = asyncio.get_event_loop()
+        try:
+            elapsed, result = await loop.run_in_executor(self.get_executor(), timed_call, func, args)
+        except concurrent.futures.process.BrokenProcessPool:
+            # A worker died (out of memory?), start new ones for the next job
+            logging.exception('%s worker died', self.name)
+            self.executor = None
+            raise errors.BusyError('The {} worker stopped, try again'.format(self.name), self.retry_after)
+        metrics.observe('worker_wait_seconds', time.perf_counter() - start - elapsed, pool=self.name)
+        metrics.observe('worker_run_seconds', elapsed, pool=self.name)
+        return result
+
+    def shutdown(self):
+        """ Stop the workers, when they have finished their jobs """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def stats(self):
+        return {'workers': self.workers,
+                'pending': self.pending,
+                'rejected': self.rejected}
+
+
+metrics.describe('worker_wait_seconds', 'Time jobs wait for a free worker, and for their arguments and results to be passed')
+metrics.describe('worker_run_seconds', 'Time spent working on jobs in the workers')